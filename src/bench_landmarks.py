@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# Per image latency of the facial landmark detection: a new FaceMesh graph for
+# every image (what find_facial_landmarks used to do) against the pooled
+# detector returned by mask_detection.get_detector
+import os
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from mask_detection import LandmarkDetector, get_detector, get_image
+
+curr_dir = os.path.dirname(os.path.realpath(__file__))
+
+def bench(images, detect, repeat):
+    times = []
+    for _ in range(repeat):
+        for img in images:
+            start = time.perf_counter()
+            detect(img)
+            times.append(time.perf_counter() - start)
+    return np.array(times)*1000
+
+def per_call_detector(img):
+    with LandmarkDetector() as detector:
+        return detector.find_facial_landmarks(img)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark landmark detection")
+    parser.add_argument("--images_dir", type=str, default=f'{curr_dir}/masked_people',
+            help="directory with the images to process")
+    parser.add_argument("--repeat", type=int, default=5, help="how many times each image is processed")
+    args = parser.parse_args()
+
+    images = [get_image(str(f)) for f in sorted(Path(args.images_dir).glob('*')) if f.is_file()]
+
+    detector = get_detector()
+    # warm up, the first call also pays the tflite delegate initialization
+    detector.find_facial_landmarks(images[0])
+
+    for name, detect in [('per call FaceMesh', per_call_detector),
+            ('pooled detector', detector.find_facial_landmarks)]:
+        times = bench(images, detect, args.repeat)
+        print(f'{name:>20}: mean {times.mean():7.2f} ms\tp50 {np.median(times):7.2f} ms' + \
+                f'\tp99 {np.percentile(times, 99):7.2f} ms\t({len(times)} images)')
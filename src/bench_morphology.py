@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+# Latency of the morphology chain of find_mask (closing, 5 erosions, 8
+# dilations) and of the 10 dilations of create_mask for each morphology method
+# across image sizes
+import time
+import argparse
+import cv2
+import numpy as np
+from mask_detection import dilate, mask_morphology
+
+methods = ['iterative', 'rect', 'distance']
+
+def bench(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return np.median(times)*1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the morphology methods")
+    parser.add_argument("--repeat", type=int, default=20, help="runs for each measure")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f'{"size":>10} {"op":>12}' + ''.join(f' {m:>10}' for m in methods) + '  (ms)')
+    for h, w in [(256, 256), (512, 512), (720, 1280), (1080, 1920), (2160, 3840)]:
+        thresh = (rng.random((h, w)) > 0.9).astype(np.uint8)
+        thresh = cv2.dilate(thresh, np.ones((7, 7), np.uint8))
+        polygon = np.zeros((h, w), np.uint8)
+        cv2.circle(polygon, (w//2, h//2), min(h, w)//4, 255, -1)
+
+        find_mask_ms = [bench(lambda: mask_morphology(thresh, m), args.repeat) for m in methods]
+        create_mask_ms = [bench(lambda: dilate(polygon, 10, m), args.repeat) for m in methods]
+        print(f'{f"{w}x{h}":>10} {"find_mask":>12}' + ''.join(f' {t:10.3f}' for t in find_mask_ms))
+        print(f'{"":>10} {"create_mask":>12}' + ''.join(f' {t:10.3f}' for t in create_mask_ms))
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# Latency of the color quantization step of find_mask and agreement (IoU) of
+# the resulting masks: cv2.kmeans over the whole image against the histogram
+# k-means over the landmark polygon only
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+from pathlib import Path
+import mask_detection
+from mask_detection import find_mask, get_detector, get_image
+
+curr_dir = os.path.dirname(os.path.realpath(__file__))
+
+def iou(a, b):
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 1.
+    return np.logical_and(a, b).sum() / union
+
+# time spent inside color_quantization while computing the mask of img
+def timed_find_mask(img, quantization, detector):
+    times = []
+    color_quantization = mask_detection.color_quantization
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        out = color_quantization(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+        return out
+    mask_detection.color_quantization = timed
+    try:
+        start = time.perf_counter()
+        mask = find_mask(img, detector=detector, quantization=quantization)
+        total = time.perf_counter() - start
+    finally:
+        mask_detection.color_quantization = color_quantization
+    return mask, sum(times)*1000, total*1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the color quantization of find_mask")
+    parser.add_argument("--images_dir", type=str, default=f'{curr_dir}/masked_people',
+            help="directory with the images to process")
+    parser.add_argument("--repeat", type=int, default=5, help="how many times each image is processed")
+    args = parser.parse_args()
+
+    detector = get_detector()
+    paths = sorted(f for f in Path(args.images_dir).glob('*') if f.is_file())
+
+    print(f'{"image":>16} {"kmeans ms":>10} {"hist ms":>10} {"speedup":>8}' + \
+            f' {"IoU hist":>9} {"IoU kmeans":>11}')
+    for path in paths:
+        img = get_image(str(path))
+        if not detector.find_facial_landmarks(img):
+            continue
+        res = {'kmeans': [], 'histogram': []}
+        for _ in range(args.repeat):
+            for quantization in res:
+                res[quantization].append(timed_find_mask(img, quantization, detector))
+
+        kmeans_ms = np.median([t for _, t, _ in res['kmeans']])
+        hist_ms = np.median([t for _, t, _ in res['histogram']])
+        reference = res['kmeans'][0][0]
+        # cv2.kmeans is randomly initialized, the agreement between two of
+        # its runs is the reference for the agreement of the histogram method
+        iou_hist = np.mean([iou(reference, m) for m, _, _ in res['histogram']])
+        iou_kmeans = np.mean([iou(reference, m) for m, _, _ in res['kmeans'][1:]])
+        print(f'{path.name:>16} {kmeans_ms:10.2f} {hist_ms:10.2f} {kmeans_ms/hist_ms:7.1f}x' + \
+                f' {iou_hist:9.3f} {iou_kmeans:11.3f}')
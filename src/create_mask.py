@@ -3,8 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import thinplate as tps
 import random
-import mediapipe as mp
 from skimage import draw
+from mask_detection import find_facial_landmarks
 from os import listdir, walk
 from os.path import isfile, join
 
@@ -34,53 +34,10 @@ bottom_face_landmarks = [0, 1, 2, 3, 4, 5, 11, 12, 13, 14, 15, 16, 17, 18, 19,
         437, 438, 439, 440, 455, 456, 457, 458, 459, 460, 462]
 
 
-fixed_landmarks = [234, 454, 447, 345, 346, 347, 348, 349, 277, 437, 399, 419,
-        197, 196, 174, 47, 120, 119, 118, 117, 116, 34, 127]
-
-def find_facial_landmarks(img, landmarks=[], debug=False):
-
-    with open('landmarks_list.txt', 'r') as f:
-        landmarks_list = [int(i) for i in f.readline().strip().split(',')]
-
-    keypoints = []
-
-    mpDraw = mp.solutions.drawing_utils
-    mpFaceMesh = mp.solutions.face_mesh
-    faceMesh = mpFaceMesh.FaceMesh(max_num_faces=1)
-    drawSpec = mpDraw.DrawingSpec(thickness=1, circle_radius=1)
-
-    imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    results = faceMesh.process(imgRGB)
-    img_land = img.copy()
-    if results.multi_face_landmarks:
-        for faceLms in results.multi_face_landmarks:
-            mpDraw.draw_landmarks(img_land,
-                    faceLms, mpFaceMesh.FACEMESH_CONTOURS, drawSpec, drawSpec)
-            #for id,lm in enumerate(faceLms.landmark):
-            #    print(lm)
-            #    ih, iw, ic = img.shape
-            #    x,y = int(lm.x*iw), int(lm.y*ih)
-            #    print(id, x,y)
-        ih,iw,ic = img.shape
-
-        for landmark in landmarks_list:
-            xc = int(faceLms.landmark[landmark].x*iw)
-            yc = int(faceLms.landmark[landmark].y*ih)
-
-            if not landmark in fixed_landmarks:
-                yc += 40
-            else:
-                yc -= 10
-            keypoints.append((xc, yc))
-    if debug:
-        cv2.imshow('landmarks', img_land)
-        cv2.waitKey(0)
-    return keypoints
-
-def find_mask(img, debug=True  ):
+def find_mask(img, debug=True, detector=None):
 
     # Keypoints detection
-    keypoints = find_facial_landmarks(img, debug=debug)
+    keypoints = find_facial_landmarks(img, debug=debug, detector=detector)
     if not keypoints:
         return np.array([])
     mask = np.zeros(img.shape, dtype=img.dtype)
@@ -0,0 +1,81 @@
+import time
+import argparse
+import resource
+import multiprocessing as mp
+
+import torch
+import torch.utils.checkpoint
+
+from layers import SelfAttention
+from generator import MSSAGenerator
+
+# channels and downsampling of the SelfAttention layers of MSSAGenerator
+# with cnum=32
+layers = {'skip_c3': (64, 4), 'skip_c4': (128, 8), 'middle2': (512, 32)}
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+# run in a fresh process, so that the peak rss is the one of this measure
+def measure(layer, mode, batch_size, input_size, backward, repeat, queue):
+    torch.manual_seed(0)
+    if layer == 'MSSAGenerator':
+        net = MSSAGenerator(input_size=input_size, attention=mode)
+        inputs = (torch.rand((batch_size, 3, input_size, input_size))*2 - 1,
+                torch.randint(0, 2, (batch_size, 1, input_size, input_size)).float())
+    else:
+        channels, scale = layers[layer]
+        net = SelfAttention(channels, mode)
+        inputs = (torch.randn((batch_size, channels, input_size//scale, input_size//scale)),)
+
+    def step():
+        if backward:
+            out = net(*inputs)
+            out = out[-1] if isinstance(out, tuple) else out
+            out.mean().backward()
+        else:
+            with torch.inference_mode():
+                net(*inputs)
+
+    # the first call of torch.utils.checkpoint (used by the chunked mode with
+    # backward) loads ~150 MB of modules, it is done before the baseline
+    x = torch.ones(1, requires_grad=True)
+    torch.utils.checkpoint.checkpoint(torch.sin, x, use_reentrant=False).backward()
+
+    baseline = peak_rss()
+    times = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - start)
+    queue.put((sorted(times[1:])[repeat//2]*1000, peak_rss() - baseline))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak memory and latency of the SelfAttention modes on CPU")
+    parser.add_argument("--layers", default=['skip_c3', 'MSSAGenerator'], nargs='+',
+            choices=list(layers) + ['MSSAGenerator'], help="layers to test")
+    parser.add_argument("--batch_sizes", default=[1, 4], type=int, nargs='+', help="batch sizes to test")
+    parser.add_argument("--input_sizes", default=[256, 384], type=int, nargs='+',
+            help="sizes of the imgs fed to MSSAGenerator")
+    parser.add_argument("--backward", action='store_true', help="measure forward + backward")
+    parser.add_argument("--repeat", default=3, type=int, help="runs for each measure")
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    print(f'{"layer":>14} {"input":>6} {"batch":>5} ' + \
+            ''.join(f'{m + " ms":>12} {m + " MB":>12}' for m in SelfAttention.modes))
+    for layer in args.layers:
+        # MSSAGenerator only works with the input size it was built for
+        input_sizes = [256] if layer == 'MSSAGenerator' else args.input_sizes
+        for input_size in input_sizes:
+            for batch_size in args.batch_sizes:
+                results = []
+                for mode in SelfAttention.modes:
+                    queue = ctx.Queue()
+                    p = ctx.Process(target=measure, args=(layer, mode, batch_size, input_size,
+                        args.backward, args.repeat, queue))
+                    p.start()
+                    results.append(queue.get())
+                    p.join()
+                print(f'{layer:>14} {input_size:>6} {batch_size:>5} ' + \
+                        ''.join(f'{ms:12.1f} {mb:12.1f}' for ms, mb in results))
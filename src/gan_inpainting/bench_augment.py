@@ -0,0 +1,56 @@
+import time
+import argparse
+
+import torch
+
+from dataset import make_augment_pipe, augment_batch
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+# AugmentPipe built at each step and applied on the CPU batch before the
+# transfer, as training.py did
+def legacy_step(imgs, masks, device):
+    aug_t = make_augment_pipe()
+    imgs_masks = torch.cat([imgs, masks], dim=1)
+    aug_imgs_masks = aug_t(imgs_masks)
+    aug_imgs, aug_masks = torch.split(aug_imgs_masks, [3,1], dim=1)
+    imgs = torch.cat([imgs, aug_imgs], dim=0)
+    masks = torch.cat([masks, aug_masks], dim=0)
+    return imgs.to(device), masks.to(device)
+
+def step(aug_t, imgs, masks, device):
+    return augment_batch(aug_t, imgs.to(device), masks.to(device))
+
+def bench(fn, device, repeat):
+    times = []
+    fn()
+    for _ in range(repeat):
+        synchronize(device)
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times)//2]*1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time per step of the training augmentation")
+    parser.add_argument("--batch_sizes", default=[2, 6], type=int, nargs='+', help="batch sizes to test")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
+    parser.add_argument("--repeat", default=10, type=int, help="runs for each measure")
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    aug_t = make_augment_pipe().to(device)
+    for batch_size in args.batch_sizes:
+        imgs = torch.rand((batch_size, 3, args.input_size, args.input_size))*255
+        masks = torch.randint(0, 2, (batch_size, 1, args.input_size, args.input_size)).float()
+        if device.type == 'cuda':
+            imgs, masks = imgs.pin_memory(), masks.pin_memory()
+
+        build_ms = bench(make_augment_pipe, device, args.repeat)
+        legacy_ms = bench(lambda: legacy_step(imgs, masks, device), device, args.repeat)
+        step_ms = bench(lambda: step(aug_t, imgs, masks, device), device, args.repeat)
+        print(f'batch {batch_size} on {device}: build AugmentPipe {build_ms:6.2f} ms' + \
+                f'\tper step: legacy {legacy_ms:7.2f} ms\tbuilt once {step_ms:7.2f} ms')
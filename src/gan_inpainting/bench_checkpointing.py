@@ -0,0 +1,73 @@
+import time
+import argparse
+import resource
+import multiprocessing as mp
+
+import torch
+import torch.utils.checkpoint
+
+from layers import SelfAttention
+from generator import MSSAGenerator, checkpoint_segments
+
+configs = {
+        'none': [],
+        'coarse_net': ['coarse_net'],
+        'middle': ['middle1', 'middle2'],
+        'all': checkpoint_segments,
+        }
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+# forward + backward of MSSAGenerator in a fresh process, so that the peak
+# rss is the one of this measure
+def measure(config, batch_size, input_size, cnum, attention, repeat, queue):
+    torch.manual_seed(0)
+    netG = MSSAGenerator(input_size=input_size, cnum=cnum, attention=attention,
+            checkpointing=configs[config])
+    netG.train()
+    imgs = torch.rand((batch_size, 3, input_size, input_size))*2 - 1
+    masks = torch.randint(0, 2, (batch_size, 1, input_size, input_size)).float()
+    # the first call of torch.utils.checkpoint loads ~150 MB of modules, it is
+    # done before the baseline in all the configs
+    x = torch.ones(1, requires_grad=True)
+    torch.utils.checkpoint.checkpoint(torch.sin, x, use_reentrant=False).backward()
+
+    baseline = peak_rss()
+    times = []
+    for _ in range(repeat + 1):
+        netG.zero_grad()
+        start = time.perf_counter()
+        emb_repr, coarse_out, refined_out = netG(imgs, masks)
+        (coarse_out.mean() + refined_out.mean() + emb_repr.mean()).backward()
+        times.append(time.perf_counter() - start)
+    queue.put((sorted(times[1:])[repeat//2]*1000, peak_rss() - baseline))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak memory and time of forward + backward of " + \
+            "MSSAGenerator with activation checkpointing on CPU")
+    parser.add_argument("--configs", default=list(configs), nargs='+', choices=list(configs),
+            help="checkpointed segments to test")
+    parser.add_argument("--input_sizes", default=[256, 512], type=int, nargs='+', help="sizes of the imgs")
+    parser.add_argument("--batch_size", default=2, type=int, help="batch size")
+    parser.add_argument("--cnum", default=32, type=int, help="base channels of the generator")
+    parser.add_argument("--attention", default='full', choices=SelfAttention.modes,
+            help="SelfAttention mode, full needs GBs for its backward at 512x512")
+    parser.add_argument("--repeat", default=3, type=int, help="runs for each measure")
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    print(f'{"input":>6} {"checkpointing":>14} {"ms":>10} {"MB":>10}')
+    for input_size in args.input_sizes:
+        for config in args.configs:
+            queue = ctx.Queue()
+            p = ctx.Process(target=measure, args=(config, args.batch_size, input_size,
+                args.cnum, args.attention, args.repeat, queue))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                # usually killed for out of memory
+                print(f'{input_size:>6} {config:>14} {"failed, exit code " + str(p.exitcode):>21}')
+                continue
+            ms, mb = queue.get()
+            print(f'{input_size:>6} {config:>14} {ms:10.1f} {mb:10.1f}')
@@ -0,0 +1,53 @@
+import time
+import argparse
+import tempfile
+
+import torch
+from torchvision import transforms as T
+
+from dataset import FaceMaskDataset, ShardedFaceMaskDataset, synthetic_dataset
+from make_shards import make_shards
+
+# time of each epoch over the whole dataset, the first one fills the cache
+def epoch_times(dataset, num_workers, batch_size, epochs):
+    loader = dataset.loader(num_workers=num_workers, batch_size=batch_size, shuffle=False)
+    times = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for imgs, masks in loader:
+            pass
+        times.append(time.perf_counter() - start)
+    return times
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Epoch time of FaceMaskDataset for different numbers of workers")
+    parser.add_argument("--dataset_dir", type=str, help="FaceMaskDataset dir, default: synthetic images")
+    parser.add_argument("--csv_file", default='maskffhq.csv', type=str, help="csv of the dataset")
+    parser.add_argument("--images", default=256, type=int, help="synthetic images to create")
+    parser.add_argument("--image_size", default=1024, type=int, help="size of the synthetic images")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs after the resize")
+    parser.add_argument("--workers", default=[0, 1, 2, 4], type=int, nargs='+', help="num_workers to test")
+    parser.add_argument("--batch_size", default=8, type=int, help="batch size")
+    parser.add_argument("--epochs", default=2, type=int, help="epochs for each measure")
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset_dir
+    if dataset_dir is None:
+        dataset_dir = tempfile.mkdtemp()
+        synthetic_dataset(dataset_dir, [args.csv_file], args.images, args.image_size)
+
+    shard_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    make_shards(dataset_dir, args.csv_file, shard_dir, args.input_size)
+    print(f'shards written in {time.perf_counter() - start:.2f}s')
+
+    datasets = {
+            'files': lambda: FaceMaskDataset(dataset_dir, args.csv_file, T.Resize(args.input_size)),
+            'cache': lambda: FaceMaskDataset(dataset_dir, args.csv_file, T.Resize(args.input_size), cache=True),
+            'shards': lambda: ShardedFaceMaskDataset(shard_dir),
+            }
+    print(f'{"workers":>7} {"backend":>7}' + ''.join(f' {f"epoch {i} (s)":>12}' for i in range(args.epochs)))
+    for backend, make_dataset in datasets.items():
+        for num_workers in args.workers:
+            times = epoch_times(make_dataset(), num_workers, args.batch_size, args.epochs)
+            print(f'{num_workers:>7} {backend:>7}' + ''.join(f' {t:12.2f}' for t in times))
@@ -0,0 +1,65 @@
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+
+from generator import MSSAGenerator
+from export import load_generator, example_inputs, export_torchscript, export_onnx
+from inference import load_network, load_exported
+
+def bench(fn, repeat):
+    times = []
+    with torch.inference_mode():
+        fn()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times)//2]*1000, out
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return (time.perf_counter() - start)*1000, out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Startup time and latency of the exported generator on CPU")
+    parser.add_argument("--checkpoint_dir", type=str, help="where to load checkpoints, default: random weights")
+    parser.add_argument("--batch_sizes", default=[1, 4], type=int, nargs='+', help="batch sizes to test")
+    parser.add_argument("--repeat", default=5, type=int, help="runs for each measure")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    checkpoint_dir = args.checkpoint_dir
+    if checkpoint_dir is None:
+        torch.manual_seed(0)
+        checkpoint_dir = tmp_dir
+        netG = torch.nn.DataParallel(MSSAGenerator(input_size=256))
+        torch.save(netG.state_dict(), f'{checkpoint_dir}/generator.pt')
+    checkpoint = f'{checkpoint_dir}/generator.pt'
+
+    net = load_generator(checkpoint)
+    paths = {'torchscript': f'{tmp_dir}/generator_ts.pt', 'onnx': f'{tmp_dir}/generator.onnx'}
+    export_ms = {'torchscript': timed(lambda: export_torchscript(net, paths['torchscript']))[0],
+            'onnx': timed(lambda: export_onnx(net, paths['onnx']))[0]}
+
+    # startup: from the file on disk to a network ready to be called
+    loaders = {'eager': lambda: load_network(checkpoint, fold=True),
+            'torchscript': lambda: load_exported(paths['torchscript']),
+            'onnx': lambda: load_exported(paths['onnx'])}
+    nets = dict()
+    for name, loader in loaders.items():
+        startup_ms, nets[name] = timed(loader)
+        size = os.path.getsize(paths.get(name, checkpoint))/2**20
+        export = f'\texport {export_ms[name]:8.1f} ms' if name in export_ms else ''
+        print(f'{name:>12}: startup {startup_ms:8.1f} ms\tfile {size:6.1f} MB' + export)
+
+    for batch_size in args.batch_sizes:
+        imgs, masks = example_inputs(batch_size=batch_size)
+        results = {name: bench(lambda: net(imgs, masks)[2], args.repeat) for name, net in nets.items()}
+        eager_out = results['eager'][1]
+        for name, (ms, out) in results.items():
+            diff = (out - eager_out).abs().max().item()
+            print(f'batch {batch_size} {name:>12}: {ms:8.1f} ms\tmax abs diff {diff:.2e}')
@@ -0,0 +1,59 @@
+import time
+import argparse
+import copy
+
+import torch
+
+from layers import GatedConv, fold_batch_norm, random_statistics
+from generator import MSSAGenerator
+
+# GatedConv.forward before the conv was shared between features and gate
+def legacy_forward(self, input):
+    x = self.conv2d(input)
+    mask = self.gate(input)
+    x = self.activation(x) * mask
+    x = self.batch_norm(x)
+    return x
+
+def bench(fn, repeat):
+    times = []
+    with torch.inference_mode():
+        fn()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times)//2]*1000, out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the GatedConv inference path on CPU")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
+    parser.add_argument("--batch_sizes", default=[1, 4], type=int, nargs='+', help="batch sizes to test")
+    parser.add_argument("--repeat", default=5, type=int, help="runs for each measure")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    netG = random_statistics(MSSAGenerator(input_size=args.input_size)).eval()
+    folded = fold_batch_norm(copy.deepcopy(netG))
+
+    for batch_size in args.batch_sizes:
+        imgs = torch.rand((batch_size, 3, args.input_size, args.input_size))*2 - 1
+        masks = torch.randint(0, 2, (batch_size, 1, args.input_size, args.input_size)).float()
+
+        x = torch.cat([imgs*(1-masks), masks], dim=1)
+
+        results = dict()
+        forward = GatedConv.forward
+        for name, net, gated_forward in [('legacy', netG, legacy_forward),
+                ('shared conv', netG, forward), ('folded bn', folded, forward)]:
+            GatedConv.forward = gated_forward
+            coarse_ms, _ = bench(lambda: net.coarse_net(x), args.repeat)
+            total_ms, out = bench(lambda: net(imgs, masks), args.repeat)
+            results[name] = (coarse_ms, total_ms, out)
+        GatedConv.forward = forward
+
+        legacy_out = results['legacy'][2]
+        for name, (coarse_ms, total_ms, out) in results.items():
+            diff = max((a - b).abs().max().item() for a, b in zip(legacy_out[1:], out[1:]))
+            print(f'batch {batch_size} {name:>12}: coarse_net {coarse_ms:8.1f} ms' + \
+                    f'\tMSSAGenerator {total_ms:8.1f} ms\tmax abs diff {diff:.2e}')
@@ -0,0 +1,65 @@
+import time
+import argparse
+
+import torch
+
+from layers import MultiDilationResnetBlock8, MultiDilationResnetBlock4, \
+        FusedMultiDilationResnetBlock8, FusedMultiDilationResnetBlock4, \
+        fuse_multi_dilation_state_dict, random_statistics
+from generator import MSSAGenerator
+
+def bench(fn, repeat):
+    times = []
+    with torch.inference_mode():
+        fn()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = fn()
+            times.append(time.perf_counter() - start)
+    return sorted(times)[len(times)//2]*1000, out
+
+def fused_copy(net, fused_net):
+    fused_net.load_state_dict(fuse_multi_dilation_state_dict(net.state_dict()))
+    return fused_net.eval()
+
+def max_diff(a, b):
+    if isinstance(a, tuple):
+        return max((x - y).abs().max().item() for x, y in zip(a[1:], b[1:]))
+    return (a - b).abs().max().item()
+
+def report(name, fn, fused_fn, repeat):
+    unfused_ms, out = bench(fn, repeat)
+    fused_ms, fused_out = bench(fused_fn, repeat)
+    print(f'{name:>28}: unfused {unfused_ms:8.1f} ms\tfused {fused_ms:8.1f} ms' + \
+            f'\tspeedup {unfused_ms/fused_ms:.2f}x\tmax abs diff {max_diff(out, fused_out):.2e}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the fused multi dilation blocks on CPU")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
+    parser.add_argument("--batch_sizes", default=[1, 4], type=int, nargs='+', help="batch sizes to test")
+    parser.add_argument("--cnum", default=32, type=int, help="cnum of MSSAGenerator")
+    parser.add_argument("--repeat", default=5, type=int, help="runs for each measure")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    channels8 = 4*args.cnum
+    channels4 = 16*args.cnum
+    block8 = random_statistics(MultiDilationResnetBlock8(channels8, channels8)).eval()
+    fused8 = fused_copy(block8, FusedMultiDilationResnetBlock8(channels8, channels8))
+    block4 = random_statistics(MultiDilationResnetBlock4(channels4, channels4)).eval()
+    fused4 = fused_copy(block4, FusedMultiDilationResnetBlock4(channels4, channels4))
+    netG = random_statistics(MSSAGenerator(input_size=args.input_size, cnum=args.cnum)).eval()
+    fusedG = fused_copy(netG, MSSAGenerator(input_size=args.input_size, cnum=args.cnum,
+        fused_dilation=True))
+
+    for batch_size in args.batch_sizes:
+        size = args.input_size
+        x8 = torch.randn((batch_size, channels8, size//4, size//4))
+        x4 = torch.randn((batch_size, channels4, size//16, size//16))
+        imgs = torch.rand((batch_size, 3, size, size))*2 - 1
+        masks = torch.randint(0, 2, (batch_size, 1, size, size)).float()
+
+        print(f'batch {batch_size}')
+        report(f'Block8 {tuple(x8.shape[1:])}', lambda: block8(x8), lambda: fused8(x8), args.repeat)
+        report(f'Block4 {tuple(x4.shape[1:])}', lambda: block4(x4), lambda: fused4(x4), args.repeat)
+        report('MSSAGenerator', lambda: netG(imgs, masks), lambda: fusedG(imgs, masks), args.repeat)
@@ -0,0 +1,80 @@
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+from torchvision import transforms as T
+
+from generator import MSSAGenerator
+from layers import random_statistics
+from dataset import FaceMaskDataset, synthetic_dataset
+from metrics import TestMetrics
+from precision import precisions, calibration_set
+from inference import load_network, infer_batch
+
+def throughput(netG, imgs, masks, repeat):
+    times = []
+    with torch.inference_mode():
+        infer_batch(imgs, masks, netG)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            infer_batch(imgs, masks, netG)
+            times.append(time.perf_counter() - start)
+    return imgs.size(0)/np.median(times)
+
+def psnr(a, b):
+    mse = torch.mean((a - b)**2).item()
+    return 100 if mse == 0 else 20*np.log10(255/np.sqrt(mse))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Quality and CPU throughput of the generator in fp32/bf16/int8")
+    parser.add_argument("--checkpoint_dir", type=str, help="where to load checkpoints, default: random weights")
+    parser.add_argument("--dataset_dir", type=str, help="FaceMaskDataset dir, default: synthetic images")
+    parser.add_argument("--calibration_csv", default='maskffhq.csv', type=str, help="csv used to calibrate int8")
+    parser.add_argument("--test_csv", default='maskceleba_test.csv', type=str, help="csv used for the metrics")
+    parser.add_argument("--calibration_images", default=32, type=int, help="images used to calibrate int8")
+    parser.add_argument("--test_images", default=16, type=int, help="images used for the metrics")
+    parser.add_argument("--batch_size", default=4, type=int, help="batch size")
+    parser.add_argument("--repeat", default=3, type=int, help="runs for each throughput measure")
+    parser.add_argument("--no_lpips", action='store_true', help="skip LPIPS (no alexnet weights)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    dataset_dir = args.dataset_dir
+    if dataset_dir is None:
+        dataset_dir = tmp_dir
+        synthetic_dataset(dataset_dir, [args.calibration_csv, args.test_csv],
+                max(args.calibration_images, args.test_images))
+    checkpoint_dir = args.checkpoint_dir
+    if checkpoint_dir is None:
+        checkpoint_dir = tmp_dir
+        torch.manual_seed(0)
+        netG = random_statistics(MSSAGenerator(input_size=256), attention_gamma=0.5)
+        torch.save(torch.nn.DataParallel(netG).state_dict(), f'{checkpoint_dir}/generator.pt')
+
+    calibration = calibration_set(dataset_dir, args.calibration_csv, args.calibration_images, args.batch_size)
+    test_set = FaceMaskDataset(dataset_dir, args.test_csv, T.Resize((256, 256)))
+    test_batches = list(torch.utils.data.DataLoader(torch.utils.data.Subset(test_set,
+        range(min(args.test_images, len(test_set)))), batch_size=args.batch_size))
+
+    reference = None
+    print(f'{"precision":>9} {"img/s":>8} {"PSNR":>8} {"SSIM":>8} {"LPIPS":>8} {"PSNR vs fp32":>13}')
+    for precision in precisions:
+        netG = load_network(f'{checkpoint_dir}/generator.pt', fold=True, precision=precision,
+                calibration=calibration)
+        metrics = TestMetrics(use_lpips=not args.no_lpips)
+        outputs = []
+        with torch.inference_mode():
+            for imgs, masks in test_batches:
+                out_imgs = infer_batch(imgs, masks*255, netG).clamp(0, 255).cpu()
+                metrics.update(imgs, out_imgs)
+                outputs.append(out_imgs)
+        outputs = torch.cat(outputs)
+        if reference is None:
+            reference = outputs
+        imgs, masks = test_batches[0]
+        speed = throughput(netG, imgs, masks*255, args.repeat)
+        m = metrics.get_metrics()
+        print(f'{precision:>9} {speed:8.2f} {m["PSNR"]:8.2f} {m["SSIM"]:8.4f} {m["LPIPS"]:8.4f}' + \
+                f' {psnr(outputs, reference):13.2f}')
@@ -0,0 +1,111 @@
+import time
+import argparse
+import resource
+import multiprocessing as mp
+
+import torch
+
+from generator import MSSAGenerator
+from discriminator import Discriminator
+from loss import GeneratorLoss, L1ReconLoss, DiscriminatorHingeLoss, TVLoss, InfoNCE
+
+# VGGLoss is left out: it needs the pretrained vgg19 weights and it is the
+# same in both steps
+
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def forward_g(netG, imgs, masks):
+    emb_repr, coarse_out, refined_out = netG(imgs, masks)
+    reconstructed_imgs = refined_out*masks + imgs*(1-masks)
+    return emb_repr, coarse_out, refined_out, reconstructed_imgs
+
+def backward_g(nets, losses, imgs, masks, dmasks, outputs):
+    netG, netD, optimG, optimD = nets
+    lossG, lossRecon, lossD, lossTV, lossContra = losses
+    emb_repr, coarse_out, refined_out, reconstructed_imgs = outputs
+    pred_neg_imgs = netD(reconstructed_imgs, masks)
+    loss = lossG(pred_neg_imgs) + lossRecon(imgs, coarse_out, refined_out, dmasks) + \
+            lossTV(refined_out) + lossContra(*emb_repr.chunk(2))
+    loss.backward()
+    optimG.step()
+
+# training.train before the D step used detached fake images
+def legacy_step(nets, losses, imgs, masks):
+    netG, netD, optimG, optimD = nets
+    lossG, lossRecon, lossD, lossTV, lossContra = losses
+    optimG.zero_grad()
+    optimD.zero_grad()
+    outputs = forward_g(netG, imgs, masks)
+    pos_neg_imgs = torch.cat([imgs, outputs[-1]], dim=0)
+    dmasks = torch.cat([masks, masks], dim=0)
+    pred_pos_imgs, pred_neg_imgs = torch.chunk(netD(pos_neg_imgs, dmasks), 2, dim=0)
+    lossD(pred_pos_imgs, pred_neg_imgs).backward(retain_graph=True)
+    optimD.step()
+    optimG.zero_grad()
+    optimD.zero_grad()
+    backward_g(nets, losses, imgs, masks, dmasks, outputs)
+
+def detached_step(nets, losses, imgs, masks):
+    netG, netD, optimG, optimD = nets
+    lossG, lossRecon, lossD, lossTV, lossContra = losses
+    optimG.zero_grad()
+    optimD.zero_grad()
+    outputs = forward_g(netG, imgs, masks)
+    pos_neg_imgs = torch.cat([imgs, outputs[-1].detach()], dim=0)
+    dmasks = torch.cat([masks, masks], dim=0)
+    pred_pos_imgs, pred_neg_imgs = torch.chunk(netD(pos_neg_imgs, dmasks), 2, dim=0)
+    lossD(pred_pos_imgs, pred_neg_imgs).backward()
+    optimD.step()
+    backward_g(nets, losses, imgs, masks, dmasks, outputs)
+
+steps = {'legacy': legacy_step, 'detached': detached_step}
+
+# run in a fresh process, so that the peak rss is the one of this measure
+def measure(name, batch_size, input_size, cnum, repeat, queue):
+    torch.manual_seed(0)
+    netG = MSSAGenerator(input_size=input_size, cnum=cnum)
+    netD = Discriminator(input_size=input_size, cnum=cnum)
+    optimG = torch.optim.Adam(netG.parameters(), lr=1e-4, betas=(0.5, 0.999))
+    optimD = torch.optim.Adam(netD.parameters(), lr=1e-4, betas=(0.5, 0.999))
+    nets = (netG, netD, optimG, optimD)
+    losses = (GeneratorLoss(), L1ReconLoss(), DiscriminatorHingeLoss(), TVLoss(), InfoNCE())
+
+    # batch of imgs followed by their augmented copy, as in training.train
+    imgs = torch.rand((2*batch_size, 3, input_size, input_size))*2 - 1
+    masks = torch.randint(0, 2, (2*batch_size, 1, input_size, input_size)).float()
+
+    baseline = peak_rss()
+    times = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        steps[name](nets, losses, imgs, masks)
+        times.append(time.perf_counter() - start)
+    # same seed and inputs, the weights after the steps tell if the updates match
+    weights = torch.cat([p.detach().flatten() for p in [*netG.parameters(), *netD.parameters()]])
+    queue.put((sorted(times[1:])[repeat//2]*1000, peak_rss() - baseline, weights))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak memory and time of a training step on CPU")
+    parser.add_argument("--batch_sizes", default=[1, 2], type=int, nargs='+',
+            help="batch sizes to test, before the augmented copy")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
+    parser.add_argument("--cnum", default=8, type=int, help="base channels of G and D")
+    parser.add_argument("--repeat", default=3, type=int, help="steps for each measure")
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    for batch_size in args.batch_sizes:
+        results = dict()
+        for name in steps:
+            queue = ctx.Queue()
+            p = ctx.Process(target=measure, args=(name, batch_size, args.input_size,
+                args.cnum, args.repeat, queue))
+            p.start()
+            results[name] = queue.get()
+            p.join()
+        legacy_weights = results['legacy'][2]
+        for name, (ms, mb, weights) in results.items():
+            diff = (weights - legacy_weights).abs().max().item()
+            print(f'batch {batch_size} {name:>9}: {ms:8.1f} ms/step {mb:8.1f} MB peak' + \
+                    f'\tmax abs weight diff {diff:.2e}')
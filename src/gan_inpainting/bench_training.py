@@ -0,0 +1,68 @@
+import time
+import argparse
+import resource
+
+import torch
+
+from generator import MSSAGenerator
+from discriminator import Discriminator
+from loss import GeneratorLoss, L1ReconLoss, TVLoss, DiscriminatorHingeLoss, VGGLoss, InfoNCE
+from dataset import FakeDataset, make_augment_pipe, augment_batch
+from precision import TrainingPrecision, training_precisions
+from training import train_step
+
+# A few steps of training.train_step on FakeDataset, on a single process
+# without DDP. VGGLoss uses random weights since the pretrained ones may not
+# be available, the cost is the same.
+def smoke_train(precision, device, steps, batch_size, input_size, cnum, accumulation_steps=1,
+        contrastive_queue=0):
+    torch.manual_seed(0)
+    netG = MSSAGenerator(input_size=input_size, cnum=cnum).to(device)
+    netD = Discriminator(input_size=input_size, cnum=cnum).to(device)
+    optimG = torch.optim.Adam(netG.parameters(), lr=1e-4, betas=(0.5, 0.999))
+    optimD = torch.optim.Adam(netD.parameters(), lr=4e-4, betas=(0.5, 0.999))
+    precision = TrainingPrecision(precision, device)
+    netG, optimG = precision.initialize(netG, optimG)
+    netD, optimD = precision.initialize(netD, optimD)
+    criterions = (GeneratorLoss(), L1ReconLoss(), TVLoss(), DiscriminatorHingeLoss(),
+            VGGLoss(device, pretrained=False), InfoNCE(queue_size=contrastive_queue))
+    aug_t = make_augment_pipe().to(device)
+
+    dataloader = FakeDataset().loader(batch_size=batch_size)
+    times = []
+    for i, (imgs, masks) in enumerate(dataloader):
+        if i == steps + 1:
+            break
+        start = time.perf_counter()
+        imgs, masks = augment_batch(aug_t, imgs.to(device), masks.to(device))
+        imgs = imgs / 127.5 - 1
+        masks = masks / 1.
+        losses, *_ = train_step(netG, netD, optimG, optimD, criterions, precision, imgs, masks,
+                accumulation_steps)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    # the first step is not timed, it allocates most of the memory
+    return len(times[1:])/sum(times[1:]), losses
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Smoke training on FakeDataset, report steps/s")
+    parser.add_argument("--precisions", default=['fp32', 'bf16'], nargs='+', choices=training_precisions,
+            help="precisions to test")
+    parser.add_argument("--device", default='cpu', choices=['cuda', 'cpu'], help="where to train")
+    parser.add_argument("--steps", default=5, type=int, help="timed steps for each precision")
+    parser.add_argument("--batch_size", default=1, type=int, help="batch size, before the augmented copy")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
+    parser.add_argument("--cnum", default=8, type=int, help="base channels of G and D")
+    parser.add_argument("--accumulation_steps", default=1, type=int, help="micro batches of each step")
+    parser.add_argument("--contrastive_queue", default=0, type=int, help="size of the InfoNCE queue")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    for precision in args.precisions:
+        steps_s, losses = smoke_train(precision, device, args.steps, args.batch_size,
+                args.input_size, args.cnum, args.accumulation_steps, args.contrastive_queue)
+        # peak of the whole process, run a single precision to compare memory
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        print(f'{precision:>5}: {steps_s:.3f} steps/s {peak:.0f} MB peak\t' + \
+                ' '.join(f'{k} {v:.3f}' for k, v in losses.items()))
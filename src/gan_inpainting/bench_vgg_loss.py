@@ -0,0 +1,54 @@
+import time
+import argparse
+
+import torch
+
+from loss import VGGLoss
+
+def bench(fn, repeat):
+    times = []
+    fn()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times)//2]*1000
+
+# forward + backward of VGGLoss as train_step calls it: the real imgs followed
+# by their augmented copies (only the first half has a dataset index) and the
+# generated images. vgg19 has random weights, the cost is the same.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the VGGLoss modes on CPU")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
+    parser.add_argument("--batch_sizes", default=[1, 2], type=int, nargs='+',
+            help="batch sizes to test, before the augmented copy")
+    parser.add_argument("--repeat", default=3, type=int, help="runs for each measure")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    modes = {
+            'legacy': VGGLoss('cpu', pretrained=False),
+            'shared': VGGLoss('cpu', pretrained=False, shared=True),
+            'shared + cache': VGGLoss('cpu', pretrained=False, shared=True, gram_cache_size=1024),
+            }
+    for loss in modes.values():
+        loss.load_state_dict(modes['legacy'].state_dict())
+
+    for batch_size in args.batch_sizes:
+        imgs = torch.rand((2*batch_size, 3, args.input_size, args.input_size))*2 - 1
+        generated = (torch.rand((2*batch_size, 3, args.input_size, args.input_size))*2 - 1).requires_grad_()
+        keys = list(range(batch_size)) + [None]*batch_size
+
+        for name, loss in modes.items():
+            def step():
+                loss_perc, loss_style = loss(imgs, generated, keys)
+                total = loss_perc*0.05 + loss_style*40
+                # the legacy mode detaches the generated features, there is
+                # nothing to backward
+                if total.requires_grad:
+                    total.backward()
+                return total
+            ms = bench(step, args.repeat)
+            generated.grad = None
+            print(f'batch {batch_size} {name:>15}: {ms:8.1f} ms\tloss {step().item():.6f}' + \
+                    f'\tgradient {"yes" if generated.grad is not None else "no"}')
@@ -0,0 +1,101 @@
+import os
+import glob
+import logging
+import threading
+from queue import Queue, Full, Empty
+
+import torch
+from torchvision.utils import save_image
+
+# copy of a (nested) state_dict with all the tensors on the cpu, so that the
+# training can keep updating the originals
+def snapshot(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+# write obj in path atomically: readers see either the old file or the new one
+def atomic_save(obj, path):
+    tmp_path = f'{path}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+def atomic_link(src, dst):
+    tmp_path = f'{dst}.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.link(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+# Saves checkpoints and preview images in a background thread. save() only
+# copies the state_dicts (and images) to the cpu, then the thread writes
+# {name}_{step}.pt for each state_dict, keeping the last keep of them, and
+# points {name}.pt to the newest one with a hard link, so the resume code can
+# keep loading {name}.pt. If the thread is still writing when a new
+# checkpoint arrives, the older pending one is dropped instead of waiting.
+class CheckpointWriter:
+    def __init__(self, checkpoint_dir, keep=3):
+        if keep < 1:
+            raise ValueError(f'keep must be at least 1, got {keep}')
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.pending = Queue(maxsize=1)
+        self.error = None
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # states: {name: state_dict}, images: {path: CxHxW tensor in [0,1]}
+    def save(self, step, states, images=None):
+        if self.error is not None:
+            raise self.error
+        job = (step, snapshot(states), snapshot(images or {}))
+        try:
+            self.pending.put_nowait(job)
+        except Full:
+            try:
+                dropped = self.pending.get_nowait()
+                # the dropped job will not reach run, pending.join() would wait for it
+                self.pending.task_done()
+                logging.warning(f'checkpoint writer busy, checkpoint of step {dropped[0]} dropped')
+            except Empty:
+                pass
+            self.pending.put_nowait(job)
+
+    def run(self):
+        while True:
+            job = self.pending.get()
+            try:
+                if job is not None:
+                    self.write(*job)
+            except Exception as e:
+                logging.exception('checkpoint writer failed')
+                self.error = e
+            finally:
+                self.pending.task_done()
+            if job is None:
+                return
+
+    def write(self, step, states, images):
+        for path, img in images.items():
+            save_image(img, path)
+        for name, state in states.items():
+            path = f'{self.checkpoint_dir}/{name}_{step:08d}.pt'
+            atomic_save(state, path)
+            atomic_link(path, f'{self.checkpoint_dir}/{name}.pt')
+            self.rotate(name)
+
+    def rotate(self, name):
+        checkpoints = sorted(glob.glob(f'{self.checkpoint_dir}/{name}_[0-9]*.pt'))
+        for path in checkpoints[:-self.keep]:
+            os.remove(path)
+
+    # wait for the pending checkpoint to be written and stop the thread
+    def close(self):
+        self.pending.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
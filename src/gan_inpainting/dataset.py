@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 import os
+import csv
+import json
 import cv2
 
 import torch
@@ -14,6 +16,23 @@ from torch.utils.data import Dataset, DataLoader
 
 from augmentation import AugmentPipe
 
+def make_augment_pipe():
+    return AugmentPipe(
+            xflip=1.,
+            xint=0.75,
+            brightness=0.75,
+            contrast=0.75,
+            hue=1.,
+            saturation=0.75)
+
+# The batch followed by its augmented copy. Images and masks are augmented
+# together so that masks get the same geometric transformations
+def augment_batch(aug_t, imgs, masks):
+    imgs_masks = torch.cat([imgs, masks], dim=1)
+    imgs_masks = torch.cat([imgs_masks, aug_t(imgs_masks)], dim=0)
+    imgs, masks = torch.split(imgs_masks, [3, 1], dim=1)
+    return imgs, masks
+
 class FakeDataset(Dataset):
     def __init__(self):
         return
@@ -27,13 +46,30 @@ class FakeDataset(Dataset):
     def loader(self, **args):
         return DataLoader(self, **args)
 
-class FaceMaskDataset(Dataset):
+# Base of the face datasets: num_workers > 0 keeps the workers of loader
+# alive between epochs and lets each of them prefetch prefetch_factor batches
+class PersistentLoaderDataset(Dataset):
+    def loader(self, num_workers=0, prefetch_factor=2, **args):
+        if num_workers > 0:
+            args.setdefault('persistent_workers', True)
+            args.setdefault('prefetch_factor', prefetch_factor)
+        return DataLoader(self, num_workers=num_workers, **args)
+
+# The paths of the csv are kept in numpy str arrays: unlike a DataFrame of
+# python objects they are not copied in every DataLoader worker when accessed.
+# With cache the decoded and transformed images are kept in memory (as uint8)
+# by the process that loaded them: with persistent workers and the same
+# sampling order at each epoch, each worker decodes its images only once.
+class FaceMaskDataset(PersistentLoaderDataset):
     # remove aug_t also in training, add AugmentPipe
-    def __init__(self, dataset_dir, csv_file, transf):
+    def __init__(self, dataset_dir, csv_file, transf, cache=False):
         self.dataset_dir = dataset_dir
-        self.images = pd.read_csv(f'{dataset_dir}/{csv_file}', dtype='str')
-        self.dataset_len = len(self.images)
+        images = pd.read_csv(f'{dataset_dir}/{csv_file}', dtype='str')
+        self.img_paths = np.array([os.path.join(dataset_dir, p) for p in images.iloc[:, 1]])
+        self.mask_paths = np.array([os.path.join(dataset_dir, p) for p in images.iloc[:, 2]])
+        self.dataset_len = len(self.img_paths)
         self.transf = transf if transf is not None else lambda x: x
+        self.cache = dict() if cache else None
 
     def __len__(self):
         return self.dataset_len
@@ -42,20 +78,86 @@ class FaceMaskDataset(Dataset):
         if torch.is_tensor(index):
             index = index.tolist()
 
-        img_name = os.path.join(self.dataset_dir, self.images.iloc[index, 1])
-        mask_name = os.path.join(self.dataset_dir, self.images.iloc[index, 2])
+        if self.cache is not None and index in self.cache:
+            img, mask = self.cache[index]
+            return img.float(), mask.float()
 
-        img = read_image(img_name)
-        mask = read_image(mask_name)
+        img = read_image(str(self.img_paths[index]))
+        mask = read_image(str(self.mask_paths[index]))
         mask = torch.div(mask, 255, rounding_mode='floor')
 
         img = self.transf(img)
         mask = self.transf(mask)
 
+        if self.cache is not None:
+            self.cache[index] = (img, mask)
+
         return img.float(), mask.float()
 
-    def loader(self, **args):
-        return DataLoader(self, **args)
+# Images and masks converted by make_shards.py: each shard is a pair of files,
+# a uint8 NxCxHxW array with the images and a uint8 array with the masks packed
+# 8 pixels per byte, and index.json lists them. The shards are opened with
+# np.memmap (once per worker) so reading an image is a read from the page cache
+# and torch.from_numpy does not copy it.
+class ShardedFaceMaskDataset(PersistentLoaderDataset):
+    def __init__(self, shard_dir, transf=None):
+        self.shard_dir = shard_dir
+        with open(f'{shard_dir}/index.json') as f:
+            index = json.load(f)
+        self.img_shape = tuple(index['img_shape'])
+        self.shards = index['shards']
+        self.offsets = np.cumsum([0] + [s['count'] for s in self.shards])
+        self.dataset_len = int(self.offsets[-1])
+        self.transf = transf if transf is not None else lambda x: x
+        self.memmaps = None
+
+    def __len__(self):
+        return self.dataset_len
+
+    def open_shards(self):
+        c, h, w = self.img_shape
+        # copy on write: writable arrays for torch.from_numpy, the file is
+        # never modified
+        self.memmaps = [(np.memmap(f'{self.shard_dir}/{s["images"]}', np.uint8, 'c', shape=(s['count'], c, h, w)),
+            np.memmap(f'{self.shard_dir}/{s["masks"]}', np.uint8, 'c', shape=(s['count'], (h*w + 7)//8)))
+            for s in self.shards]
+
+    def __getitem__(self, index):
+        if torch.is_tensor(index):
+            index = index.tolist()
+        if self.memmaps is None:
+            self.open_shards()
+
+        shard = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        images, masks = self.memmaps[shard]
+        i = index - self.offsets[shard]
+        _, h, w = self.img_shape
+
+        img = torch.from_numpy(images[i])
+        mask = torch.from_numpy(np.unpackbits(masks[i], count=h*w).reshape(1, h, w))
+
+        img = self.transf(img)
+        mask = self.transf(mask)
+
+        return img.float(), mask.float()
+
+# random images (blurred noise) with a mask on the lower half, written in
+# dataset_dir with a csv in the FaceMaskDataset format, used by the benchmarks
+def synthetic_dataset(dataset_dir, csv_files, num_images, input_size=256, seed=0):
+    rng = np.random.default_rng(seed)
+    for csv_file in csv_files:
+        with open(f'{dataset_dir}/{csv_file}', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'img', 'mask'])
+            for i in range(num_images):
+                name = f'{csv_file.split(".")[0]}_{i}'
+                img = cv2.GaussianBlur(rng.integers(0, 256, (input_size, input_size, 3), np.uint8), (15, 15), 0)
+                mask = np.zeros((input_size, input_size), np.uint8)
+                cv2.ellipse(mask, (input_size//2, 3*input_size//4), (input_size//4, input_size//6),
+                        0, 0, 360, 255, -1)
+                cv2.imwrite(f'{dataset_dir}/{name}.png', img)
+                cv2.imwrite(f'{dataset_dir}/{name}_mask.png', mask)
+                writer.writerow([name, f'{name}.png', f'{name}_mask.png'])
 
 if __name__ == "__main__":
     dataset = FaceMaskDataset('../dataset/', 'maskffhq.csv')
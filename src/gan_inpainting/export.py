@@ -0,0 +1,81 @@
+import argparse
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from layers import SelfAttention, fold_batch_norm, fuse_multi_dilation_state_dict
+from generator import MSSAGenerator
+
+# Only the refined images of MSSAGenerator, the output used by inference.py
+class RefineGenerator(nn.Module):
+    def __init__(self, netG):
+        super(RefineGenerator, self).__init__()
+        self.netG = netG
+
+    def forward(self, imgs, masks):
+        return self.netG(imgs, masks)[2]
+
+# the checkpoints are saved from a DataParallel, drop its module. prefix
+def strip_data_parallel(state_dict):
+    return OrderedDict((k[len('module.'):] if k.startswith('module.') else k, v)
+            for k, v in state_dict.items())
+
+# MSSAGenerator without DataParallel, in eval mode with BatchNorm folded
+def load_generator(checkpoint, fused=False, attention='full'):
+    netG = MSSAGenerator(input_size=256, fused_dilation=fused, attention=attention)
+    state_dict = strip_data_parallel(torch.load(checkpoint, map_location='cpu'))
+    if fused:
+        state_dict = fuse_multi_dilation_state_dict(state_dict)
+    netG.load_state_dict(state_dict)
+    fold_batch_norm(netG)
+    return RefineGenerator(netG).eval()
+
+def example_inputs(input_size=256, batch_size=1):
+    imgs = torch.rand((batch_size, 3, input_size, input_size))*2 - 1
+    masks = torch.zeros((batch_size, 1, input_size, input_size))
+    masks[..., input_size//2:, input_size//4:3*input_size//4] = 1
+    return imgs, masks
+
+# traced and frozen: weights are constants of the graph
+def export_torchscript(net, path, input_size=256):
+    with torch.no_grad():
+        traced = torch.jit.trace(net, example_inputs(input_size))
+        frozen = torch.jit.freeze(traced)
+    frozen.save(path)
+    return frozen
+
+# weights are stored as initializers and folded where possible, batch size
+# and image size are dynamic
+def export_onnx(net, path, input_size=256, opset=17):
+    dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ['imgs', 'masks', 'refined']}
+    with torch.no_grad():
+        torch.onnx.export(net, example_inputs(input_size), path,
+                input_names=['imgs', 'masks'], output_names=['refined'],
+                dynamic_axes=dynamic_axes, opset_version=opset,
+                do_constant_folding=True, dynamo=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the refine path of the generator")
+    parser.add_argument("--checkpoint_dir", type=str, help="where to load checkpoints", required=True)
+    parser.add_argument("--output", type=str, help="the exported network (.pt or .onnx)", required=True)
+    parser.add_argument("--format", default=None, choices=['torchscript', 'onnx'],
+            help="default: from the extension of --output")
+    parser.add_argument("--fused_dilation", action='store_true', help="use the fused multi dilation blocks")
+    parser.add_argument("--attention", default='full', choices=SelfAttention.modes,
+            help="how the SelfAttention layers compute the attention")
+    parser.add_argument("--input_size", default=256, type=int, help="size of the example imgs")
+    args = parser.parse_args()
+    if args.attention not in SelfAttention.traceable_modes:
+        parser.error(f'--attention {args.attention} can not be traced, use one of {SelfAttention.traceable_modes}')
+
+    export_format = args.format or ('onnx' if args.output.endswith('.onnx') else 'torchscript')
+
+    print("Loading network...")
+    net = load_generator(f'{args.checkpoint_dir}/generator.pt', args.fused_dilation, args.attention)
+
+    print(f"Exporting {export_format} to {args.output}...")
+    if export_format == 'onnx':
+        export_onnx(net, args.output, args.input_size)
+    else:
+        export_torchscript(net, args.output, args.input_size)
@@ -1,8 +1,11 @@
+from contextlib import contextmanager, nullcontext
+
 import numpy as np
 
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+import torch.utils.checkpoint
 
 from layers import *
 from init_weights import init_weights
@@ -11,14 +14,72 @@ def get_pad(in_,  ksize, stride, atrous=1):
     out_ = np.ceil(float(in_)/stride)
     return int(((out_ - 1) * stride + atrous*(ksize-1) + 1 - in_)/2)
 
+def multi_dilation_blocks(fused):
+    if fused:
+        return FusedMultiDilationResnetBlock8, FusedMultiDilationResnetBlock4
+    return MultiDilationResnetBlock8, MultiDilationResnetBlock4
+
+# attention: the SelfAttention mode of all the layers, or a dict with the mode
+# of each layer (missing layers use 'full')
+def attention_modes(attention, layers):
+    if isinstance(attention, str):
+        return {layer: attention for layer in layers}
+    return {layer: attention.get(layer, 'full') for layer in layers}
+
+checkpoint_segments = ['coarse_net', 'middle1', 'middle2']
+multi_dilation_types = (MultiDilationResnetBlock8, MultiDilationResnetBlock4, FusedMultiDilationResnetBlock)
+
+# checkpointing: the segments (of checkpoint_segments) whose
+# MultiDilationResnetBlocks are recomputed in backward, True for all of them
+def checkpointed_segments(checkpointing):
+    if checkpointing is True:
+        return set(checkpoint_segments)
+    checkpointing = set(checkpointing or [])
+    if not checkpointing <= set(checkpoint_segments):
+        raise ValueError(f'unknown segments {checkpointing - set(checkpoint_segments)}, ' + \
+                f'expected some of {checkpoint_segments}')
+    return checkpointing
+
+# the recomputation in backward must not update the running statistics of
+# the batch norms a second time, momentum 0 keeps them as they are (and
+# num_batches_tracked is restored)
+@contextmanager
+def frozen_batch_norm(module):
+    batch_norms = [m for m in module.modules()
+            if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    states = [(m.momentum, m.num_batches_tracked.clone()) for m in batch_norms]
+    for m in batch_norms:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(batch_norms, states):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+# run the layers of a nn.Sequential, the MultiDilationResnetBlocks through
+# torch.utils.checkpoint: only their inputs are kept for backward, the branch
+# activations are computed again
+def checkpoint_sequential(layers, x):
+    for layer in layers:
+        if isinstance(layer, multi_dilation_types):
+            x = torch.utils.checkpoint.checkpoint(layer, x, use_reentrant=False,
+                    context_fn=lambda layer=layer: (nullcontext(), frozen_batch_norm(layer)))
+        else:
+            x = layer(x)
+    return x
+
 # TODO: maybe this get_pad function can be removed and implemented inside the
 # gated conv layer, this will also remove the dependency from the img size of
 # 256x256
 # The img size dependency can be removed easy by setting a variable and *2 or /2
 # each time we down/upsample
 class Generator(nn.Module):
-    def __init__(self, input_channels=4, input_size=1024, cnum=32):
+    # fused_dilation: use FusedMultiDilationResnetBlock8/4, the checkpoints of
+    # the unfused network must be converted with fuse_multi_dilation_state_dict
+    def __init__(self, input_channels=4, input_size=1024, cnum=32, fused_dilation=False):
         super(Generator, self).__init__()
+        MultiDilationResnetBlock8, MultiDilationResnetBlock4 = multi_dilation_blocks(fused_dilation)
         if input_size%4 != 0:
             raise 'input_size%4 != 0'
 
@@ -128,13 +189,23 @@ class Generator(nn.Module):
         return coarse_result, refine_result
 
 class MSSAGenerator(nn.Module):
-    def __init__(self, input_channels=4, input_size=1024, cnum=32):
+    # fused_dilation: use FusedMultiDilationResnetBlock8/4, the checkpoints of
+    # the unfused network must be converted with fuse_multi_dilation_state_dict
+    # attention: SelfAttention mode of skip_c3, skip_c4 and middle2, see
+    # attention_modes
+    # checkpointing: segments recomputed in backward while training, see
+    # checkpointed_segments. Less memory for about one more forward of them
+    def __init__(self, input_channels=4, input_size=1024, cnum=32, fused_dilation=False,
+            attention='full', checkpointing=None):
         super(MSSAGenerator, self).__init__()
+        MultiDilationResnetBlock8, MultiDilationResnetBlock4 = multi_dilation_blocks(fused_dilation)
+        attention = attention_modes(attention, ['skip_c3', 'skip_c4', 'middle2'])
         if input_size%4 != 0:
             raise 'input_size%4 != 0'
 
         self.cnum = cnum
         self.size = input_size
+        self.checkpointing = checkpointed_segments(checkpointing)
         self.pad = nn.ReplicationPad2d
         self.coarse_net = nn.Sequential(
                 GatedConv(input_channels, self.cnum, 5, 1, padding=get_pad(self.size, 5, 1)),
@@ -185,7 +256,7 @@ class MSSAGenerator(nn.Module):
                 self.pad(1),
                 nn.Conv2d(self.cnum*4, self.cnum*2, 3, 1, padding=0),
                 nn.LeakyReLU(0.2, True),
-                SelfAttention(self.cnum*2)
+                SelfAttention(self.cnum*2, attention['skip_c3'])
                 )
         self.c4 = nn.Sequential(
                 self.pad(1),
@@ -196,7 +267,7 @@ class MSSAGenerator(nn.Module):
                 self.pad(1),
                 nn.Conv2d(self.cnum*8, self.cnum*4, 3, 1, padding=0),
                 nn.LeakyReLU(0.2, True),
-                SelfAttention(self.cnum*4)
+                SelfAttention(self.cnum*4, attention['skip_c4'])
                 )
         self.middle1 = nn.Sequential(
                 self.pad(1),
@@ -207,7 +278,7 @@ class MSSAGenerator(nn.Module):
                 MultiDilationResnetBlock4(self.cnum*16, self.cnum*16, 3, 1, 1),
                 )
         self.middle2 = nn.Sequential(
-                SelfAttention(self.cnum*16),
+                SelfAttention(self.cnum*16, attention['middle2']),
                 MultiDilationResnetBlock4(self.cnum*16, self.cnum*16, 3, 1, 1),
                 MultiDilationResnetBlock4(self.cnum*16, self.cnum*16, 3, 1, 1),
                 MultiDilationResnetBlock4(self.cnum*16, self.cnum*16, 3, 1, 1),
@@ -246,13 +317,20 @@ class MSSAGenerator(nn.Module):
                 self.pad(3),
                 nn.Conv2d(self.cnum, 3, 7, 1, padding=0),
                 )
-        self.avgpool = nn.AvgPool2d(16)
+        # the same as AvgPool2d(16) at 256x256, also works at other sizes
+        self.avgpool = nn.AdaptiveAvgPool2d(1)
+
+    def run_segment(self, name, x):
+        layers = getattr(self, name)
+        if name in self.checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint_sequential(layers, x)
+        return layers(x)
 
     def forward(self, input_images, input_masks):
         # coarse
         masked_images = input_images*(1-input_masks)
         x = torch.cat([masked_images, input_masks], dim=1)
-        x = self.coarse_net(x)
+        x = self.run_segment('coarse_net', x)
         x = torch.tanh(x)
         coarse_result = x
 
@@ -264,8 +342,8 @@ class MSSAGenerator(nn.Module):
         x3 = self.c3(x) # 64x64x128
         x4 = self.c4(x3) # 32x32x256
 
-        emb_repr = self.middle1(x4)   # 16x16x512
-        x = self.middle2(emb_repr)   # 16x16x512
+        emb_repr = self.run_segment('middle1', x4)   # 16x16x512
+        x = self.run_segment('middle2', emb_repr)   # 16x16x512
 
         x3 = self.skip_c3(x3) # 64x64x64
         x4 = self.skip_c4(x4) # 32x32x32
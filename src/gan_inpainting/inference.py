@@ -9,53 +9,193 @@ from generator import *
 from discriminator import Discriminator
 from loss import *
 from metrics import TestMetrics
+from precision import precisions, convert_precision, calibration_set
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-def load_network(checkpoint):
-    netG = MSSAGenerator(input_size=256)
+# fold: put the network in eval mode and fold its BatchNorm layers, see
+# layers.fold_batch_norm
+# fused: use the fused multi dilation blocks, the checkpoint is converted
+# attention: SelfAttention mode, see generator.attention_modes
+# precision: fp32, bf16 or int8 (CPU only), int8 needs a calibration set, see
+# precision.convert_precision
+def load_network(checkpoint, fold=False, fused=False, attention='full', precision='fp32',
+        calibration=None):
+    netG = MSSAGenerator(input_size=256, fused_dilation=fused, attention=attention)
     netG.to(device)
     netG = torch.nn.DataParallel(netG)
     checkpointG = torch.load(checkpoint, map_location=device)
+    if fused:
+        checkpointG = fuse_multi_dilation_state_dict(checkpointG)
     netG.load_state_dict(checkpointG)
+    if fold:
+        fold_batch_norm(netG)
+    if precision != 'fp32':
+        netG = convert_precision(netG, precision, calibration)
     return netG
 
-def infer(img, mask, netG):
-    img = img.to(device)
-    img = img / 127.5 - 1
-    mask = mask / 255.
-    print(mask.max())
+# Refine path exported by export.py, run with TorchScript or onnxruntime (for
+# .onnx files) on CPU. Called as netG(imgs, masks) it returns the same tuple of
+# MSSAGenerator, with only the refined images, so it can be used in place of
+# the network returned by load_network
+class ExportedGenerator:
+    def __init__(self, path):
+        self.path = path
+        if path.endswith('.onnx'):
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path, map_location='cpu')
 
-    _, _, refined_out = netG(img.unsqueeze(0), mask.unsqueeze(0))
+    def __call__(self, imgs, masks):
+        imgs, masks = imgs.float().cpu(), masks.float().cpu()
+        if self.session is not None:
+            refined_out = self.session.run(['refined'], {
+                'imgs': imgs.numpy(), 'masks': masks.numpy()})[0]
+            refined_out = torch.from_numpy(refined_out)
+        else:
+            refined_out = self.module(imgs, masks)
+        return None, None, refined_out.to(device)
 
-    refined_out = refined_out[0]
-    reconstructed_img = refined_out*mask + img*(1-mask)
+def load_exported(path):
+    return ExportedGenerator(path)
 
-    return (reconstructed_img + 1) * 127.5
+def inpaint(imgs, masks, netG):
+    imgs = imgs / 127.5 - 1
+    masks = masks / 255.
+
+    _, _, refined_out = netG(imgs, masks)
+
+    reconstructed_imgs = refined_out*masks + imgs*(1-masks)
+
+    return (reconstructed_imgs + 1) * 127.5
+
+# imgs: Nx3xHxW in [0,255], masks: Nx1xHxW in [0,255]
+# Only the images with at least min_mask_pixels pixels to inpaint go through
+# the network, the others are returned as they are
+def infer_batch(imgs, masks, netG, min_mask_pixels=1):
+    imgs = imgs.to(device).float()
+    masks = masks.to(device).float()
+
+    todo = torch.nonzero((masks > 0).flatten(1).sum(1) >= min_mask_pixels).flatten()
+    if len(todo) == len(imgs):
+        return inpaint(imgs, masks, netG)
+    if len(todo) == 0:
+        return imgs
+
+    out_imgs = imgs.clone()
+    out_imgs[todo] = inpaint(imgs[todo], masks[todo], netG)
+    return out_imgs
+
+def infer(img, mask, netG, min_mask_pixels=1):
+    return infer_batch(img.unsqueeze(0), mask.unsqueeze(0), netG, min_mask_pixels)[0]
+
+# size of the images fed to the network: shorter side of size pixels and both
+# sides multiple of 16 as the generator requires
+def network_size(height, width, size=256):
+    r = size/min(height, width)
+    return max(round(height*r/16), 1)*16, max(round(width*r/16), 1)*16
+
+# window of the image around the bounding box of the mask: a square context
+# times the bbox (at least size pixels), moved inside the image. Returns
+# (top, left, height, width) or None if the mask is empty
+def crop_window(mask, size=256, context=2.):
+    ys, xs = torch.nonzero(mask[0] > 0, as_tuple=True)
+    if len(ys) == 0:
+        return None
+    height, width = mask.shape[1:]
+    y0, y1, x0, x1 = ys.min().item(), ys.max().item() + 1, xs.min().item(), xs.max().item() + 1
+    side = max(size, round(context*max(y1 - y0, x1 - x0)))
+    h, w = min(side, height), min(side, width)
+    top = min(max((y0 + y1 - h)//2, 0), height - h)
+    left = min(max((x0 + x1 - w)//2, 0), width - w)
+    return top, left, h, w
+
+# Inpaint a full resolution img by running the network only on crop_window:
+# the window is resized to network_size (nothing to do if it is already size
+# pixels), inpainted, resized back and pasted over the masked pixels of img.
+# The pixels outside the mask are the ones of img.
+# img: 3xHxW in [0,255], mask: 1xHxW in [0,255]
+def infer_crop(img, mask, netG, size=256, context=2.):
+    img = img.float()
+    window = crop_window(mask, size, context)
+    if window is None:
+        return img
+    top, left, h, w = window
+    img_crop = img[:, top:top+h, left:left+w]
+    mask_crop = mask[:, top:top+h, left:left+w].float()
+
+    net_size = network_size(h, w, size)
+    out_crop = infer(T.Resize(net_size)(img_crop), T.Resize(net_size)(mask_crop), netG)
+    if net_size != (h, w):
+        out_crop = T.Resize((h, w))(out_crop)
+
+    m = mask_crop.to(out_crop.device) / 255.
+    out_crop = out_crop*m + img_crop.to(out_crop.device)*(1-m)
+
+    out_img = img.to(out_crop.device, copy=True)
+    out_img[:, top:top+h, left:left+w] = torch.where(m > 0, out_crop, out_img[:, top:top+h, left:left+w])
+    return out_img
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Infering")
     parser.add_argument("--input_img", type=str, help="The input image", required=True)
     parser.add_argument("--input_mask", type=str, help="The input mask", required=True)
     parser.add_argument("--output", type=str, help="Where to save the output image", required=True)
-    parser.add_argument("--checkpoint_dir", type=str, help="where to load/save checkpoints", required=True)
+    parser.add_argument("--checkpoint_dir", type=str, help="where to load/save checkpoints")
+    parser.add_argument("--exported", type=str, help="use this network exported by export.py instead")
+    parser.add_argument("--fold_bn", action='store_true', help="eval mode with BatchNorm folded")
+    parser.add_argument("--fused_dilation", action='store_true', help="use the fused multi dilation blocks")
+    parser.add_argument("--attention", default='full', choices=SelfAttention.modes,
+            help="how the SelfAttention layers compute the attention")
+    parser.add_argument("--precision", default='fp32', choices=precisions,
+            help="bf16 runs under CPU autocast, int8 is quantized with a calibration set")
+    parser.add_argument("--calibration_dataset_dir", type=str,
+            help="FaceMaskDataset used to calibrate int8")
+    parser.add_argument("--calibration_csv", default='maskffhq.csv', type=str,
+            help="csv of the calibration dataset")
+    parser.add_argument("--calibration_images", default=32, type=int, help="images used to calibrate int8")
+    parser.add_argument("--crop", action='store_true',
+            help="keep the input resolution and run the network only around the mask")
     args = parser.parse_args()
+    if args.checkpoint_dir is None and args.exported is None:
+        parser.error('one of --checkpoint_dir or --exported is required')
+    if args.precision == 'int8' and args.calibration_dataset_dir is None:
+        parser.error('--precision int8 requires --calibration_dataset_dir')
+    if args.precision == 'int8' and args.attention not in SelfAttention.traceable_modes:
+        # quantize_int8 traces the generator with torch.fx
+        parser.error(f'--precision int8 can not trace --attention {args.attention}, ' + \
+                f'use one of {SelfAttention.traceable_modes}')
 
     print("Loading network...")
-    netG = load_network(f'{args.checkpoint_dir}/generator.pt')
+    if args.exported is not None:
+        netG = load_exported(args.exported)
+    else:
+        calibration = None
+        if args.precision == 'int8':
+            calibration = calibration_set(args.calibration_dataset_dir, args.calibration_csv,
+                    args.calibration_images)
+        netG = load_network(f'{args.checkpoint_dir}/generator.pt', args.fold_bn, args.fused_dilation,
+                args.attention, args.precision, calibration)
 
     with torch.inference_mode():
         print(f"Loading input image ({args.input_img})...")
         img = read_image(args.input_img)
-        img = T.Resize(256)(img)
+        if not args.crop:
+            img = T.Resize(256)(img)
         print("loaded img: ", img.shape)
 
         print(f"Loading input mask({args.input_mask})...")
         mask = read_image(args.input_mask, ImageReadMode.GRAY)
-        mask = T.Resize(256)(mask)
+        mask = T.Resize(img.shape[1:])(mask)
         print("loaded mask: ", mask.shape)
 
         print("Processing image...")
-        out_img = infer(img, mask, netG)
+        if args.crop:
+            out_img = infer_crop(img, mask, netG)
+        else:
+            out_img = infer(img, mask, netG)
 
     save_image(out_img/255, args.output)
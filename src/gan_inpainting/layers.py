@@ -1,6 +1,10 @@
+import re
+from collections import OrderedDict
+
 import numpy as np
 
 import torch
+import torch.utils.checkpoint
 import torch.nn.functional as F
 import torch.nn as nn
 
@@ -30,12 +34,66 @@ class GatedConv(nn.Module):
         # the same conv layer is applied to x and mask, in the reference code x
         # and mask are joined togheter then split to apply sigmoid to mask only
         # peraphs this latter approach is better
+        # self.gate shares its conv with self.conv2d, so the conv is computed
+        # once and only the sigmoid of the gate is applied to it
         x = self.conv2d(input)
-        mask = self.gate(input)
+        mask = self.gate[1](x)
         x = self.activation(x) * mask
         x = self.batch_norm(x)
         return x
 
+# per channel x*scale + shift, an eval mode BatchNorm2d with its statistics
+# already applied
+class ChannelAffine(nn.Module):
+    def __init__(self, batch_norm):
+        super(ChannelAffine, self).__init__()
+        scale, shift = batch_norm_affine(batch_norm)
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
+
+    def forward(self, input):
+        return torch.addcmul(self.shift, input, self.scale)
+
+def batch_norm_affine(batch_norm):
+    scale = batch_norm.running_var.add(batch_norm.eps).rsqrt()
+    shift = -batch_norm.running_mean*scale
+    if batch_norm.affine:
+        scale = scale*batch_norm.weight
+        shift = shift*batch_norm.weight + batch_norm.bias
+    return scale.detach(), shift.detach()
+
+# Inference only: replace the BatchNorm2d of every GatedConv of net with its
+# eval mode affine transformation. When the next layer of a nn.Sequential is a
+# GatedConv without padding the affine is folded inside its conv, otherwise
+# (zero padding would be shifted by the folded bias at the borders) it is kept
+# as a single ChannelAffine.
+@torch.no_grad()
+def fold_batch_norm(net):
+    net.eval()
+    for module in list(net.modules()):
+        if not isinstance(module, nn.Sequential):
+            continue
+        layers = list(module)
+        for layer, next_layer in zip(layers, layers[1:] + [None]):
+            if not isinstance(layer, GatedConv) or not isinstance(layer.batch_norm, nn.BatchNorm2d):
+                continue
+            conv = next_layer.conv2d if isinstance(next_layer, GatedConv) else None
+            if conv is not None and conv.groups == 1 and \
+                    conv.padding_mode == 'zeros' and all(p == 0 for p in conv.padding):
+                scale, shift = batch_norm_affine(layer.batch_norm)
+                if conv.bias is None:
+                    conv.bias = nn.Parameter(torch.zeros(conv.out_channels, device=conv.weight.device))
+                conv.bias += (conv.weight*shift.view(1, -1, 1, 1)).sum((1, 2, 3))
+                conv.weight *= scale.view(1, -1, 1, 1)
+                layer.batch_norm = nn.Identity()
+            else:
+                layer.batch_norm = ChannelAffine(layer.batch_norm)
+    for module in net.modules():
+        if isinstance(module, (GatedConv, FusedMultiDilationResnetBlock)) and \
+                isinstance(module.batch_norm, nn.BatchNorm2d):
+            module.batch_norm = ChannelAffine(module.batch_norm)
+    return net
+
 class DeConv(nn.Module):
     def __init__(self,
             scale_factor,
@@ -85,10 +143,27 @@ class GatedDeConv(nn.Module):
         x = self.gatedconv(x)
         return x
 
+# mode selects how the attention is computed, all of them give the same result:
+# - 'full' builds the whole (H*W)x(H*W) attention matrix
+# - 'chunked' processes chunk_size queries at a time, so only a
+#   chunk_size x (H*W) slice of the matrix exists at once. With autograd each
+#   chunk is checkpointed and recomputed in backward, otherwise the softmax
+#   of every chunk would be saved and the whole matrix kept in pieces
+# - 'sdpa' uses F.scaled_dot_product_attention, that picks a fused kernel
+#   which never materialises the matrix, also in the backward pass
+# 'chunked' loops in python over the image size, torch.jit.trace and torch.fx
+# would fix the number of chunks: traceable_modes can be exported/quantized.
 class SelfAttention(nn.Module):
-    def __init__(self, input_channels):
+    modes = ['full', 'chunked', 'sdpa']
+    traceable_modes = ['full', 'sdpa']
+
+    def __init__(self, input_channels, mode='full', chunk_size=1024):
         super(SelfAttention, self).__init__()
+        if mode not in self.modes:
+            raise ValueError(f'unknown attention mode {mode}, expected one of {self.modes}')
         self.input_channels = input_channels
+        self.mode = mode
+        self.chunk_size = chunk_size
         self.query_conv = nn.Conv2d(input_channels, input_channels//8, 1)
         self.key_conv = nn.Conv2d(input_channels, input_channels//8, 1)
         self.value_conv = nn.Conv2d(input_channels, input_channels, 1)
@@ -99,16 +174,35 @@ class SelfAttention(nn.Module):
         m_batchsize, C, width, height = input.size()
         proj_query  = self.query_conv(input).view(m_batchsize, -1, width*height).permute(0,2,1) # B X CX(N)
         proj_key =  self.key_conv(input).view(m_batchsize, -1, width*height) # B X C x (*W*H)
-        energy =  torch.bmm(proj_query, proj_key) # transpose check
-        attention = self.softmax(energy) # BX (N) X (N)
         proj_value = self.value_conv(input).view(m_batchsize, -1, width*height) # B X C X N
 
-        out = torch.bmm(proj_value, attention.permute(0,2,1))
-        out = out.view(m_batchsize, C, width, height)
+        if self.mode == 'sdpa':
+            # the fused kernels want query, key and value of the same size and
+            # a contiguous value: zero channels added to query and key leave
+            # the energy unchanged. No 1/sqrt(C) scaling, as in the energy below
+            pad = (0, C - proj_query.size(2))
+            out = F.scaled_dot_product_attention(F.pad(proj_query, pad),
+                    F.pad(proj_key.permute(0,2,1), pad), proj_value.permute(0,2,1).contiguous(),
+                    scale=1.)
+            out = out.permute(0,2,1)
+        elif self.mode == 'chunked':
+            attend = self.attend
+            if torch.is_grad_enabled():
+                attend = lambda *args: torch.utils.checkpoint.checkpoint(self.attend, *args, use_reentrant=False)
+            out = torch.cat([attend(proj_query[:, i:i+self.chunk_size], proj_key, proj_value)
+                for i in range(0, width*height, self.chunk_size)], dim=2)
+        else:
+            out = self.attend(proj_query, proj_key, proj_value)
+        out = out.reshape(m_batchsize, C, width, height)
 
         out = self.gamma*out + input
         return out
 
+    def attend(self, proj_query, proj_key, proj_value):
+        energy =  torch.bmm(proj_query, proj_key) # transpose check
+        attention = self.softmax(energy) # BX (N) X (N)
+        return torch.bmm(proj_value, attention.permute(0,2,1))
+
 class SpectralNormConv(nn.Module):
     def __init__(self,
             input_channels,
@@ -194,3 +288,116 @@ class MultiDilationResnetBlock4(nn.Module):
         b5 = torch.cat((b1, b2, b3, b4), dim=1)
         out = x + self.concatenation(b5)
         return out
+
+# Same computation of MultiDilationResnetBlock8/4 with the weights of the
+# branches stacked together: every branch conv writes in a slice of the same
+# preallocated tensor, then activation, gate and BatchNorm run once over all
+# the branches and no torch.cat is needed. Checkpoints of the unfused blocks
+# can be loaded after fuse_multi_dilation_state_dict.
+class FusedMultiDilationResnetBlock(nn.Module):
+    def __init__(self, input_channels, output_channels, dilations):
+        super(FusedMultiDilationResnetBlock, self).__init__()
+        self.dilations = dilations
+        branch_channels = output_channels//len(dilations)
+        branches = [nn.Conv2d(input_channels, branch_channels, 3, 1, d, d) for d in dilations]
+        self.weight = nn.Parameter(torch.stack([b.weight.data for b in branches]))
+        self.bias = nn.Parameter(torch.stack([b.bias.data for b in branches]))
+        self.activation = nn.ReLU()
+        self.batch_norm = nn.BatchNorm2d(branch_channels*len(dilations))
+
+        self.concatenation = GatedConv(input_channels, output_channels, 3, 1, 1, 1, activation=None)
+
+    def forward(self, x):
+        n, _, h, w = x.shape
+        branch_channels = self.weight.size(1)
+        b = x.new_empty((n, branch_channels*len(self.dilations), h, w))
+        for i, d in enumerate(self.dilations):
+            b[:, i*branch_channels:(i+1)*branch_channels] = F.conv2d(x,
+                    self.weight[i], self.bias[i], 1, d, d)
+        b = self.activation(b) * torch.sigmoid(b)
+        b = self.batch_norm(b)
+        out = x + self.concatenation(b)
+        return out
+
+class FusedMultiDilationResnetBlock8(FusedMultiDilationResnetBlock):
+    def __init__(self,
+            input_channels,
+            output_channels,
+            kernel_size=3,
+            stride=1,
+            padding=1,
+            dilation=1,
+            groups=1,
+            bias=True):
+        super(FusedMultiDilationResnetBlock8, self).__init__(input_channels,
+                output_channels, [2, 3, 4, 5, 6, 8, 10, 1])
+
+class FusedMultiDilationResnetBlock4(FusedMultiDilationResnetBlock):
+    def __init__(self,
+            input_channels,
+            output_channels,
+            kernel_size=3,
+            stride=1,
+            padding=1,
+            dilation=1,
+            groups=1,
+            bias=True):
+        super(FusedMultiDilationResnetBlock4, self).__init__(input_channels,
+                output_channels, [1, 2, 4, 8])
+
+# Convert a state_dict with MultiDilationResnetBlock8/4 to one with the fused
+# blocks: the branchN weights are stacked in branch order, the BatchNorm2d
+# are concatenated and the gate copies of the convs are dropped.
+def fuse_multi_dilation_state_dict(state_dict):
+    branch_key = re.compile(r'^(.*\.)?branch(\d+)\.(conv2d|gate|batch_norm)\.(.*)$')
+    fused = OrderedDict()
+    blocks = OrderedDict()
+    for key, value in state_dict.items():
+        match = branch_key.match(key)
+        if match is None:
+            fused[key] = value
+            continue
+        block, branch, layer, name = match.groups()
+        block = block or ''
+        if layer == 'gate':
+            continue
+        if block not in blocks:
+            # keep the position of the block inside the state_dict
+            fused[block] = None
+            blocks[block] = dict()
+        blocks[block].setdefault(f'{layer}.{name}', dict())[int(branch)] = value
+
+    for block, params in blocks.items():
+        stacked = dict()
+        for name, branches in params.items():
+            values = [branches[i] for i in sorted(branches)]
+            if name == 'conv2d.weight':
+                stacked[f'{block}weight'] = torch.stack(values)
+            elif name == 'conv2d.bias':
+                stacked[f'{block}bias'] = torch.stack(values)
+            elif name == 'batch_norm.num_batches_tracked':
+                stacked[f'{block}{name}'] = values[0]
+            else:
+                stacked[f'{block}{name}'] = torch.cat(values)
+        fused[block] = stacked
+
+    out = OrderedDict()
+    for key, value in fused.items():
+        if key in blocks:
+            out.update(value)
+        else:
+            out[key] = value
+    return out
+
+# For tests and benchmarks: random BatchNorm statistics (and the gamma of the
+# SelfAttention layers set to attention_gamma, if given) as a trained network
+# would have, the init values hide the errors of folding and fusing
+@torch.no_grad()
+def random_statistics(net, attention_gamma=None):
+    for module in net.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2)
+        if attention_gamma is not None and isinstance(module, SelfAttention):
+            module.gamma.fill_(attention_gamma)
+    return net
@@ -77,9 +77,9 @@ class TVLoss(nn.Module):
         return t.size()[1] * t.size()[2] * t.size()[3]
 
 class Vgg19(nn.Module):
-    def __init__(self, requires_grad=False):
+    def __init__(self, requires_grad=False, pretrained=True):
         super(Vgg19, self).__init__()
-        vgg_pretrained_features = models.vgg19(pretrained=True).features
+        vgg_pretrained_features = models.vgg19(pretrained=pretrained).features
         self.slice1 = nn.Sequential()
         self.slice2 = nn.Sequential()
         self.slice3 = nn.Sequential()
@@ -112,16 +112,25 @@ class Vgg19(nn.Module):
         return out
 
 class VGGLoss(nn.Module):
-    # vgg19 perceptual loss
-    def __init__(self, gpu):
+    # vgg19 perceptual loss, device is a torch.device or the index of a gpu.
+    # pretrained=False is only meant for benchmarks without the weights
+    # With shared, x are the real images and y the generated ones: x and y
+    # are normalized together, x goes through vgg19 without graph and only y
+    # gets gradients (the default mode detaches the features of y, so only x
+    # would). gram_cache_size > 0 keeps the gram matrices of up to that many
+    # real images, keyed by the dataset index given to forward.
+    def __init__(self, device, pretrained=True, shared=False, gram_cache_size=0):
         super(VGGLoss, self).__init__()
-        self.vgg = Vgg19().cuda(gpu)
+        self.vgg = Vgg19(pretrained=pretrained).to(device)
         self.criterion = nn.L1Loss()
         self.mse_loss = nn.MSELoss()
+        self.shared = shared
+        self.gram_cache_size = gram_cache_size
+        self.gram_cache = dict()
 
         self.weights = [1.0/32, 1.0/16, 1.0/8, 1.0/4, 1.0]
-        mean = torch.Tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1).cuda(gpu)
-        std = torch.Tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1).cuda(gpu)
+        mean = torch.Tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1).to(device)
+        std = torch.Tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1).to(device)
         self.register_buffer('mean', mean)
         self.register_buffer('std', std)
 
@@ -132,7 +141,37 @@ class VGGLoss(nn.Module):
         gram = features.bmm(features_t) / (ch * h * w)
         return gram
 
-    def forward(self, x, y):
+    # gram matrices of the features of the real images, keys has the
+    # dataset index of each image or None if it can not be cached (e.g.
+    # augmented images)
+    @torch.no_grad()
+    def real_gram_matrices(self, x_vgg, keys=None):
+        if keys is None or self.gram_cache_size == 0:
+            return [self.gram_matrix(f) for f in x_vgg]
+
+        grams = [f.new_empty((f.shape[0], f.shape[1], f.shape[1])) for f in x_vgg]
+        cached = [i for i, key in enumerate(keys) if key in self.gram_cache]
+        for i in cached:
+            for s, g in enumerate(self.gram_cache[keys[i]]):
+                grams[s][i] = g
+        # the rows that can be cached and the others (e.g. the augmented
+        # copies) are computed apart, so that only the former are kept
+        keyed = [i for i, key in enumerate(keys) if key is not None and key not in self.gram_cache]
+        unkeyed = [i for i, key in enumerate(keys) if key is None]
+        for rows in (keyed, unkeyed):
+            if rows:
+                for s, f in enumerate(x_vgg):
+                    grams[s][rows] = self.gram_matrix(f[rows])
+        for i in keyed:
+            if len(self.gram_cache) < self.gram_cache_size:
+                # a copy, a view would keep the grams of the whole batch alive
+                self.gram_cache[keys[i]] = [g[i].clone() for g in grams]
+        return grams
+
+    def forward(self, x, y, keys=None):
+        if self.shared:
+            return self.shared_forward(x, y, keys)
+
         x = (x - self.mean) / self.std
         y = (y - self.mean) / self.std
         x_vgg, y_vgg = self.vgg(x), self.vgg(y)
@@ -146,6 +185,21 @@ class VGGLoss(nn.Module):
             style_loss += self.weights[i] * self.mse_loss(gm_x, gm_y.detach())
         return loss, style_loss
 
+    def shared_forward(self, x, y, keys=None):
+        x, y = torch.chunk((torch.cat([x, y], dim=0) - self.mean) / self.std, 2, dim=0)
+        with torch.no_grad():
+            x_vgg = self.vgg(x)
+            gm_xs = self.real_gram_matrices(x_vgg, keys)
+        y_vgg = self.vgg(y)
+
+        loss = 0
+        style_loss = 0
+        for i in range(len(x_vgg)):
+            loss += self.weights[i] * self.criterion(x_vgg[i], y_vgg[i])
+            gm_y = self.gram_matrix(y_vgg[i])
+            style_loss += self.weights[i] * self.mse_loss(gm_xs[i], gm_y)
+        return loss, style_loss
+
 class InfoNCE(nn.Module):
     """
     from: https://raw.githubusercontent.com/RElbers/info-nce-pytorch/main/info_nce/__init__.py
@@ -174,13 +228,41 @@ class InfoNCE(nn.Module):
          Value of the InfoNCE Loss.
     """
 
-    def __init__(self, temperature=0.1, reduction='mean'):
+    # queue_size > 0 keeps the (detached, normalized) positive keys of the
+    # last queue_size samples, MoCo style, and uses them as negatives together
+    # with the in-batch ones when negative_keys is None. With gradient
+    # accumulation this gives the contrastive term the negatives of the whole
+    # batch without keeping the graph of the previous micro batches. There is
+    # no momentum encoder: the keys come from slightly older weights of the
+    # same network, so the queue should span only a few steps.
+    def __init__(self, temperature=0.1, reduction='mean', queue_size=0):
         super().__init__()
         self.temperature = temperature
         self.reduction = reduction
+        self.queue_size = queue_size
+        self.queue = None
 
     def forward(self, query, positive_key, negative_keys=None):
-        return info_nce(query, positive_key, negative_keys, temperature=self.temperature, reduction=self.reduction)
+        if self.queue_size == 0 or negative_keys is not None:
+            return info_nce(query, positive_key, negative_keys, temperature=self.temperature, reduction=self.reduction)
+
+        query, positive_key = normalize(query, positive_key)
+        # positive keys on the diagonal, then the keys in the queue
+        logits = query @ transpose(positive_key)
+        if self.queue is not None:
+            logits = torch.cat([logits, query @ transpose(self.queue)], dim=1)
+        labels = torch.arange(len(query), device=query.device)
+        loss = F.cross_entropy(logits / self.temperature, labels, reduction=self.reduction)
+
+        self.enqueue(positive_key)
+        return loss
+
+    # newest keys first, the oldest ones are dropped
+    def enqueue(self, keys):
+        keys = keys.detach()
+        if self.queue is not None:
+            keys = torch.cat([keys, self.queue], dim=0)
+        self.queue = keys[:self.queue_size]
 
 
 def info_nce(query, positive_key, negative_keys=None, temperature=0.1, reduction='mean'):
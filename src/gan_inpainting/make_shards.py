@@ -0,0 +1,57 @@
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+from torchvision import transforms as T
+
+from dataset import FaceMaskDataset
+
+# Convert the images and masks of a FaceMaskDataset csv, resized to
+# input_size x input_size, to the shards read by ShardedFaceMaskDataset
+def make_shards(dataset_dir, csv_file, output_dir, input_size=256, shard_size=4096,
+        num_workers=0, report_every=1000):
+    dataset = FaceMaskDataset(dataset_dir, csv_file, T.Resize((input_size, input_size)))
+    os.makedirs(output_dir, exist_ok=True)
+    img_shape = (3, input_size, input_size)
+    packed_size = (input_size*input_size + 7)//8
+
+    shards = []
+    images = masks = None
+    loader = dataset.loader(num_workers=num_workers, batch_size=None, shuffle=False)
+    for index, (img, mask) in enumerate(loader):
+        i = index % shard_size
+        if i == 0:
+            count = min(shard_size, len(dataset) - index)
+            shard = {'images': f'images_{len(shards):05d}.u8', 'masks': f'masks_{len(shards):05d}.u8',
+                    'count': count}
+            shards.append(shard)
+            images = np.memmap(f'{output_dir}/{shard["images"]}', np.uint8, 'w+', shape=(count, *img_shape))
+            masks = np.memmap(f'{output_dir}/{shard["masks"]}', np.uint8, 'w+', shape=(count, packed_size))
+
+        images[i] = img.round().clamp(0, 255).byte().numpy()
+        masks[i] = np.packbits(mask.numpy().reshape(-1) > 0.5)
+        if i == count - 1:
+            images.flush()
+            masks.flush()
+        if (index + 1) % report_every == 0:
+            print(f'[{index + 1}/{len(dataset)}] images converted')
+
+    with open(f'{output_dir}/index.json', 'w') as f:
+        json.dump({'img_shape': img_shape, 'shards': shards}, f, indent=2)
+    return shards
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a FaceMaskDataset to memory mapped shards")
+    parser.add_argument("--dataset_dir", type=str, help="dataset location", required=True)
+    parser.add_argument("--csv_file", default='maskffhq.csv', type=str, help="csv of the dataset")
+    parser.add_argument("--output_dir", type=str, help="where to write the shards", required=True)
+    parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
+    parser.add_argument("--shard_size", default=4096, type=int, help="images in each shard")
+    parser.add_argument("--num_workers", default=4, type=int, help="processes decoding the images")
+    args = parser.parse_args()
+
+    shards = make_shards(args.dataset_dir, args.csv_file, args.output_dir, args.input_size,
+            args.shard_size, args.num_workers)
+    print(f'{sum(s["count"] for s in shards)} images in {len(shards)} shards')
@@ -106,11 +106,12 @@ class TrainingMetrics:
 
 
 class TestMetrics:
-    def __init__(self):
+    # use_lpips=False skips LPIPS, that needs the pretrained alexnet weights
+    def __init__(self, use_lpips=True):
         self.ssim = []
         self.pnsr = []
         self.lpips = []
-        self.loss_alex = lpips.LPIPS(net='alex').to(device)
+        self.loss_alex = lpips.LPIPS(net='alex').to(device) if use_lpips else None
 
     def update(self, original, generated):
         if len(original.shape) != 4:
@@ -122,14 +123,16 @@ class TestMetrics:
 
         for i in range(batch_size):
             self.ssim.append(self.SSIM(original[i], generated[i]))
-            self.lpips.append(self.LPIPS(original[i], generated[i]))
+            if self.loss_alex is not None:
+                self.lpips.append(self.LPIPS(original[i], generated[i]))
             self.pnsr.append(self.PSNR(original[i], generated[i]))
 
     '''
         return a dict with metrics
     '''
     def get_metrics(self):
-        return dict({"SSIM": np.mean(self.ssim), "PSNR": np.mean(self.pnsr), "LPIPS": np.mean(self.lpips)})
+        return dict({"SSIM": np.mean(self.ssim), "PSNR": np.mean(self.pnsr),
+            "LPIPS": np.mean(self.lpips) if self.lpips else float('nan')})
 
     '''
         plot metrics and save it
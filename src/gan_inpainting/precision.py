@@ -0,0 +1,110 @@
+import torch
+import torch.nn as nn
+from torchvision import transforms as T
+
+from dataset import FaceMaskDataset
+
+precisions = ['fp32', 'bf16', 'int8']
+
+# Run the generator under CPU autocast, the outputs are converted back to
+# float32 so the callers don't need to know about it
+class AutocastGenerator(nn.Module):
+    def __init__(self, netG, dtype=torch.bfloat16):
+        super(AutocastGenerator, self).__init__()
+        self.netG = netG
+        self.dtype = dtype
+
+    def forward(self, imgs, masks):
+        with torch.autocast('cpu', dtype=self.dtype):
+            out = self.netG(imgs, masks)
+        return tuple(o.float() for o in out)
+
+# num_images random images of FaceMaskDataset, in batches as given by its
+# loader: imgs in [0,255], masks in {0,1}
+def calibration_set(dataset_dir, csv_file='maskffhq.csv', num_images=32, batch_size=4,
+        input_size=256, seed=0):
+    dataset = FaceMaskDataset(dataset_dir, csv_file, T.Resize((input_size, input_size)))
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:num_images].tolist()
+    subset = torch.utils.data.Subset(dataset, indices)
+    return list(torch.utils.data.DataLoader(subset, batch_size=batch_size))
+
+# Static post training quantization with FX graph mode: observers are put on
+# the activations, calibration runs the network over the batches of
+# calibration_set and then convs and linear layers are replaced with their
+# int8 version. The ops without an int8 kernel (bmm and softmax of
+# SelfAttention, tanh, sigmoid gates...) run in float32 between
+# dequantize/quantize.
+@torch.no_grad()
+def quantize_int8(netG, calibration, backend='x86'):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    netG = netG.module if isinstance(netG, nn.DataParallel) else netG
+    netG.eval()
+
+    example_imgs, example_masks = calibration[0]
+    prepared = prepare_fx(netG, get_default_qconfig_mapping(backend),
+            (example_imgs / 127.5 - 1, example_masks))
+    for imgs, masks in calibration:
+        prepared(imgs / 127.5 - 1, masks)
+    return convert_fx(prepared)
+
+# netG in the given precision, calibration is needed only for int8
+def convert_precision(netG, precision, calibration=None):
+    if precision not in precisions:
+        raise ValueError(f'unknown precision {precision}, expected one of {precisions}')
+    if precision == 'bf16':
+        return AutocastGenerator(netG.eval())
+    if precision == 'int8':
+        if calibration is None:
+            raise ValueError('int8 needs a calibration set')
+        return quantize_int8(netG, calibration)
+    return netG
+
+training_precisions = ['fp32', 'fp16', 'bf16', 'apex']
+
+# Mixed precision of training.train. fp16 and bf16 run the forward passes
+# under torch.autocast, fp16 also scales the losses with a GradScaler to not
+# underflow the gradients, bf16 has the exponent range of float32 and works
+# on CPU too. apex is the amp O2 path used before native amp, it is imported
+# only when selected.
+class TrainingPrecision:
+    def __init__(self, precision, device):
+        if precision not in training_precisions:
+            raise ValueError(f'unknown precision {precision}, expected one of {training_precisions}')
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        self.dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=precision == 'fp16')
+        if precision == 'apex':
+            from apex import amp
+            self.amp = amp
+
+    def initialize(self, net, optim):
+        if self.precision == 'apex':
+            return self.amp.initialize(net, optim, opt_level='O2')
+        return net, optim
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype,
+                enabled=self.precision in ['fp16', 'bf16'])
+
+    def backward(self, loss, optim):
+        if self.precision == 'apex':
+            with self.amp.scale_loss(loss, optim) as scaled_loss:
+                scaled_loss.backward()
+        else:
+            self.scaler.scale(loss).backward()
+
+    # steps are skipped by the GradScaler if the gradients have inf/nan
+    def step(self, optim):
+        if self.precision == 'apex':
+            optim.step()
+        else:
+            self.scaler.step(optim)
+
+    # once per training step, after all the optimizers did their step
+    def update(self):
+        self.scaler.update()
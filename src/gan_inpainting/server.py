@@ -0,0 +1,212 @@
+import os
+import time
+import json
+import base64
+import socket
+import logging
+import argparse
+import threading
+from queue import Queue, Empty
+from collections import Counter, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from torchvision import transforms as T
+from torchvision.io import ImageReadMode, decode_image, encode_png
+
+from inference import load_network, infer_batch, network_size
+
+class Request:
+    def __init__(self, img, mask):
+        self.img = img
+        self.mask = mask
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+class ServerMetrics:
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+
+    def update(self, batch_size, latencies):
+        with self.lock:
+            self.batch_sizes[batch_size] += 1
+            self.latencies.extend(latencies)
+            self.requests += batch_size
+
+    def get_metrics(self, queue_depth):
+        with self.lock:
+            latencies = np.array(self.latencies)*1000
+            return {
+                'queue_depth': queue_depth,
+                'requests': self.requests,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'latency_ms': {
+                    'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                    },
+                }
+
+# Keeps the generator loaded and coalesces the requests submitted by
+# concurrent clients into micro batches: a batch is run as soon as it has
+# max_batch_size requests or the oldest request waited max_wait_ms. Requests
+# are batched together only if images have the same size. Images whose mask
+# has less than min_mask_pixels pixels are returned without running the net.
+class DynamicBatcher:
+    def __init__(self, netG, max_batch_size=8, max_wait_ms=10, min_mask_pixels=1):
+        self.netG = netG
+        self.min_mask_pixels = min_mask_pixels
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = Queue()
+        self.pending = []
+        self.metrics = ServerMetrics()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # img: 3xHxW uint8, mask: 1xHxW uint8, return the future of the inpainted img
+    def submit(self, img, mask):
+        request = Request(img, mask)
+        self.queue.put(request)
+        return request.future
+
+    def queue_depth(self):
+        return self.queue.qsize() + len(self.pending)
+
+    def next_batch(self):
+        if not self.pending:
+            self.pending.append(self.queue.get())
+        deadline = self.pending[0].arrival + self.max_wait
+        while len(self.pending) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                self.pending.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+
+        shape = self.pending[0].img.shape
+        batch = [r for r in self.pending if r.img.shape == shape][:self.max_batch_size]
+        self.pending = [r for r in self.pending if r not in batch]
+        return batch
+
+    def run(self):
+        with torch.inference_mode():
+            while True:
+                batch = self.next_batch()
+                try:
+                    imgs = torch.stack([r.img for r in batch]).float()
+                    masks = torch.stack([r.mask for r in batch]).float()
+                    out_imgs = infer_batch(imgs, masks, self.netG, self.min_mask_pixels)
+                    out_imgs = out_imgs.clamp(0, 255).round().byte().cpu()
+                except Exception as e:
+                    for r in batch:
+                        r.future.set_exception(e)
+                    continue
+                done = time.perf_counter()
+                # before the results, a client that got its image sees it in the metrics
+                self.metrics.update(len(batch), [done - r.arrival for r in batch])
+                for r, out_img in zip(batch, out_imgs):
+                    r.future.set_result(out_img)
+
+# POST /infer with a json body {"image": <base64 of an encoded image>,
+# "mask": <base64 of an encoded mask>}, both are resized to the network_size
+# of the image (shorter side of input_size pixels, the aspect ratio is kept)
+# and the response is the png of the inpainted image. GET /metrics return the metrics
+# as json.
+class InferenceHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        batcher = self.server.batcher
+        body = json.dumps(batcher.metrics.get_metrics(batcher.queue_depth())).encode()
+        self.reply(200, 'application/json', body)
+
+    def do_POST(self):
+        if self.path != '/infer':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+            data = json.loads(self.rfile.read(length))
+            img = decode_image(torch.frombuffer(bytearray(base64.b64decode(data['image'])), dtype=torch.uint8),
+                    ImageReadMode.RGB)
+            mask = decode_image(torch.frombuffer(bytearray(base64.b64decode(data['mask'])), dtype=torch.uint8),
+                    ImageReadMode.GRAY)
+            img = T.Resize(network_size(*img.shape[1:], self.server.input_size))(img)
+            mask = T.Resize(img.shape[1:])(mask)
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+
+        try:
+            out_img = self.server.batcher.submit(img, mask).result()
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.reply(200, 'image/png', encode_png(out_img).numpy().tobytes())
+
+    def reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def make_server(netG, host='127.0.0.1', port=8000, unix_socket=None,
+        max_batch_size=8, max_wait_ms=10, input_size=256, min_mask_pixels=1):
+    if unix_socket is not None:
+        server = UnixHTTPServer(unix_socket, InferenceHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.batcher = DynamicBatcher(netG, max_batch_size, max_wait_ms, min_mask_pixels)
+    server.input_size = input_size
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inference server")
+    parser.add_argument("--checkpoint_dir", type=str, help="where to load checkpoints", required=True)
+    parser.add_argument("--host", default='127.0.0.1', type=str, help="address to listen on")
+    parser.add_argument("--port", default=8000, type=int, help="port to listen on")
+    parser.add_argument("--unix_socket", type=str, help="listen on this unix socket instead of host:port")
+    parser.add_argument("--max_batch_size", default=8, type=int, help="max number of images in a batch")
+    parser.add_argument("--max_wait_ms", default=10, type=float, help="max time a request waits for a batch")
+    parser.add_argument("--input_size", default=256, type=int, help="shorter side of the imgs")
+    parser.add_argument("--min_mask_pixels", default=1, type=int,
+            help="images with a smaller mask are returned without inpainting")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    print("Loading network...")
+    netG = load_network(f'{args.checkpoint_dir}/generator.pt', fold=True)
+
+    server = make_server(netG, args.host, args.port, args.unix_socket,
+            args.max_batch_size, args.max_wait_ms, args.input_size,
+            args.min_mask_pixels)
+    print(f'Listening on {args.unix_socket or f"{args.host}:{args.port}"}')
+    server.serve_forever()
@@ -1,6 +1,9 @@
 import argparse
 import logging
 import os
+import time
+from collections import defaultdict
+from contextlib import nullcontext
 
 import numpy as np
 import cv2
@@ -16,18 +19,142 @@ from torch.utils.data import ConcatDataset, DataLoader
 from torch.nn.parallel import DistributedDataParallel as DDP
 import torch.multiprocessing as mp
 
-from apex import amp
-
 import matplotlib.pyplot as plt
 
 from generator import *
 from discriminator import Discriminator
 from loss import *
-from dataset import FakeDataset, FaceMaskDataset
+from dataset import FakeDataset, FaceMaskDataset, ShardedFaceMaskDataset, make_augment_pipe, augment_batch
 
 from metrics import TrainingMetrics
+from checkpoint import CheckpointWriter
+from precision import TrainingPrecision, training_precisions
+
+# Batches are made of two halves: imgs followed by their augmented copies for
+# G, real followed by fake images for D. split_halves cuts such a batch in n
+# micro batches, each one with its part of both halves, join_halves puts
+# them back in the order of the whole batch.
+def split_halves(x, n):
+    return [torch.cat(parts, dim=0) for parts in zip(*[h.chunk(n) for h in x.chunk(2)])]
+
+def join_halves(xs):
+    halves = [x.chunk(2) for x in xs]
+    return torch.cat([h[0] for h in halves] + [h[1] for h in halves], dim=0)
+
+# forward G under autocast, outputs in float32
+def forward_g(netG, precision, imgs, masks):
+    with precision.autocast():
+        emb_repr, coarse_out, refined_out = netG(imgs, masks)
+    return emb_repr.float(), coarse_out.float(), refined_out.float()
+
+# DDP all-reduces the gradients at every backward, with micro batches only
+# the backward of the last one has to. DDP decides it in the forward, so both
+# the forward and the backward of a micro batch run in this context
+def sync_gradients(net, sync):
+    if sync or not isinstance(net, DDP):
+        return nullcontext()
+    return net.no_sync()
+
+# One step of D and one of G on a batch of imgs in [-1,+1]. criterions are
+# lossG, lossRecon, lossTV, lossD, lossVGG and lossContra. The forward
+# passes run under the autocast of precision, the losses in float32.
+# With accumulation_steps > 1 the batch is split in micro batches whose
+# gradients are accumulated before each optimizer step: the D step runs G
+# without graph (and without updating the batch norm statistics) on every
+# micro batch, the G step runs it again with the graph, one micro batch at a
+# time. The last batch of an epoch can give fewer micro batches, losses are
+# averaged over the ones there are. The contrastive term of a micro batch
+# only sees its own negatives, unless lossContra keeps a queue of the
+# previous ones. indices are the dataset indices of the imgs (not of their
+# augmented copies), used by lossVGG to cache the gram matrices of the real
+# images.
+# Return the losses as floats (mean over the micro batches), the total loss
+# of G and the outputs used by metrics and previews.
+def train_step(netG, netD, optimG, optimD, criterions, precision, imgs, masks, accumulation_steps=1,
+        indices=None):
+    lossG, lossRecon, lossTV, lossD, lossVGG, lossContra = criterions
+    losses = defaultdict(float)
+    micro_batches = list(zip(split_halves(imgs, accumulation_steps),
+        split_halves(masks, accumulation_steps)))
+    n = len(micro_batches)
+    # -1 for the augmented copies, they have no key
+    keys = [None]*n
+    if indices is not None:
+        keys = [[k if k >= 0 else None for k in micro_keys.tolist()] for micro_keys in
+                split_halves(torch.cat([indices, torch.full_like(indices, -1)]), accumulation_steps)]
+
+    netG.zero_grad()
+    netD.zero_grad()
+    optimG.zero_grad()
+    optimD.zero_grad()
+
+    # forward G + D, loss + backward D
+    outputs = []
+    preds = []
+    for j, (imgs, masks) in enumerate(micro_batches):
+        with sync_gradients(netD, j == n - 1):
+            # with a single micro batch the graph of G is kept for the G step,
+            # otherwise G runs again there and updates the statistics
+            with torch.set_grad_enabled(n == 1), frozen_batch_norm(netG) if n > 1 else nullcontext():
+                emb_repr, coarse_out, refined_out = forward_g(netG, precision, imgs, masks)
+            reconstructed_imgs = refined_out*masks + imgs*(1-masks)
+            outputs.append((emb_repr, coarse_out, refined_out))
 
-from augmentation import AugmentPipe
+            # the D step only updates D: fake images are detached, so its
+            # backward stops at them and the graph of G is not needed twice
+            pos_neg_imgs = torch.cat([imgs, reconstructed_imgs.detach()], dim=0)
+            dmasks = torch.cat([masks, masks], dim=0)
+            with precision.autocast():
+                pred_pos_neg_imgs = netD(pos_neg_imgs, dmasks).float()
+            pred_pos_imgs, pred_neg_imgs = torch.chunk(pred_pos_neg_imgs, 2, dim=0)
+            preds.append(pred_pos_neg_imgs.detach())
+
+            loss_discriminator = lossD(pred_pos_imgs, pred_neg_imgs) / n
+            losses['d'] += loss_discriminator.item()
+            precision.backward(loss_discriminator, optimD)
+    precision.step(optimD)
+
+    # loss + backward G, D is run again on the fake images because it
+    # has just been updated
+    coarses = []
+    recons = []
+    loss_gen_recon = 0
+    for j, ((imgs, masks), (emb_repr, coarse_out, refined_out), micro_keys) in \
+            enumerate(zip(micro_batches, outputs, keys)):
+        with sync_gradients(netG, j == n - 1), sync_gradients(netD, j == n - 1):
+            if n > 1:
+                emb_repr, coarse_out, refined_out = forward_g(netG, precision, imgs, masks)
+            reconstructed_coarses = coarse_out*masks + imgs*(1-masks)
+            reconstructed_imgs = refined_out*masks + imgs*(1-masks)
+            dmasks = torch.cat([masks, masks], dim=0)
+
+            with precision.autocast():
+                pred_neg_imgs = netD(reconstructed_imgs, masks).float()
+            loss_generator = lossG(pred_neg_imgs)
+            loss_recon = lossRecon(imgs, coarse_out, refined_out, dmasks)
+            loss_tv = lossTV(refined_out)
+            loss_perc, loss_style = lossVGG(imgs, refined_out, micro_keys)
+            loss_perc *= 0.05
+            loss_style *= 40
+            loss_contra = lossContra(*emb_repr.chunk(2))
+            loss_micro = (loss_generator + loss_recon + \
+                    loss_tv + loss_perc + loss_style + loss_contra) / n
+
+            losses['g'] += loss_generator.item() / n
+            losses['r'] += loss_recon.item() / n
+            losses['tv'] += loss_tv.item() / n
+            losses['perc'] += loss_perc.item() / n
+            losses['style'] += loss_style.item() / n
+            losses['contra'] += loss_contra.item() / n
+
+            precision.backward(loss_micro, optimG)
+        loss_gen_recon += loss_micro.detach()
+        coarses.append(reconstructed_coarses.detach())
+        recons.append(reconstructed_imgs.detach())
+    precision.step(optimG)
+    precision.update()
+
+    return dict(losses), loss_gen_recon, join_halves(preds), join_halves(coarses), join_halves(recons)
 
 # torch.autograd.set_detect_anomaly(True)
 # a loss history should be held to keep tracking if the network is learning
@@ -36,21 +163,28 @@ from augmentation import AugmentPipe
 def train(gpu, args):
     logging.basicConfig(filename='output.log', level=logging.INFO)
     rank = args.nr * args.gpus + gpu
+    cuda = args.device == 'cuda'
+    device = torch.device('cuda', gpu) if cuda else torch.device('cpu')
     dist.init_process_group(
-        backend='nccl',
+        backend='nccl' if cuda else 'gloo',
         init_method='env://',
         world_size=args.world_size,
         rank=rank
     )
     torch.manual_seed(0)
-    torch.cuda.set_device(gpu)
-    logging.info(f'[p#{rank}] joined the training on gpu#{gpu}!')
-
-    dataset = FaceMaskDataset(
-            args.dataset_dir,
-            'maskffhq.csv',
-            T.Resize(args.input_size)
-        )
+    if cuda:
+        torch.cuda.set_device(gpu)
+    logging.info(f'[p#{rank}] joined the training on {device}!')
+
+    if args.shard_dir is not None:
+        dataset = ShardedFaceMaskDataset(args.shard_dir)
+    else:
+        dataset = FaceMaskDataset(
+                args.dataset_dir,
+                'maskffhq.csv',
+                T.Resize(args.input_size),
+                cache=args.cache_dataset
+            )
 
     sampler = torch.utils.data.distributed.DistributedSampler(
         dataset,
@@ -58,19 +192,23 @@ def train(gpu, args):
         rank=rank
     )
 
-    dataloader = DataLoader(
-            dataset=dataset,
+    dataloader = dataset.loader(
             batch_size=args.batch_size,
             shuffle=False,
-            pin_memory=True,
-            num_workers=0,
+            pin_memory=cuda,
+            num_workers=args.num_workers,
+            prefetch_factor=args.prefetch_factor,
             sampler=sampler)
+    # the dataset indices of each batch: the sampler gives the same order
+    # each time it is iterated (set_epoch is never called)
+    batch_indices = torch.utils.data.BatchSampler(sampler, args.batch_size, drop_last=False)
 
-    netG = MSSAGenerator(input_size=args.input_size)
+    netG = MSSAGenerator(input_size=args.input_size, attention=args.attention,
+            checkpointing=args.checkpointing)
     netD = Discriminator(input_size=args.input_size)
 
-    netG.cuda(gpu)
-    netD.cuda(gpu)
+    netG.to(device)
+    netD.to(device)
 
 
     optimG = torch.optim.Adam(
@@ -84,11 +222,12 @@ def train(gpu, args):
                 betas=(0.5, 0.999)
             )
 
-    netG, optimG = amp.initialize(netG, optimG, opt_level='O2')
-    netD, optimD = amp.initialize(netD, optimD, opt_level='O2')
+    precision = TrainingPrecision(args.precision, device)
+    netG, optimG = precision.initialize(netG, optimG)
+    netD, optimD = precision.initialize(netD, optimD)
 
-    netG = DDP(netG, device_ids=[gpu])
-    netD = DDP(netD, device_ids=[gpu])
+    netG = DDP(netG, device_ids=[gpu] if cuda else None)
+    netD = DDP(netD, device_ids=[gpu] if cuda else None)
     # Resume checkpoint if necessary
     if args.checkpoint is True:
         generator_dir = f'{args.checkpoint_dir}/generator.pt'
@@ -120,11 +259,13 @@ def train(gpu, args):
     lossRecon = L1ReconLoss()
     lossTV = TVLoss()
     lossD = DiscriminatorHingeLoss()
-    lossVGG = VGGLoss(gpu)
-    lossContra = InfoNCE()
+    lossVGG = VGGLoss(device, shared=args.shared_vgg, gram_cache_size=args.vgg_gram_cache)
+    lossContra = InfoNCE(queue_size=args.contrastive_queue)
+    criterions = (lossG, lossRecon, lossTV, lossD, lossVGG, lossContra)
 
-    # only rank 0 update metrics
+    # only rank 0 update metrics and saves checkpoints
     if(rank == 0):
+        checkpoint_writer = CheckpointWriter(args.checkpoint_dir, args.keep_checkpoints)
         logging.info(f'[p#{rank}] preparing the metric class')
         metrics = TrainingMetrics(
                 args.screenstep,
@@ -136,111 +277,59 @@ def train(gpu, args):
     netG.train()
     netD.train()
 
-    losses = {
-            'g': [],
-            'd': [],
-            'r': [],
-            'tv': [],
-            'perc': [],
-            'style': [],
-            'contra': []
-            }
-
     accuracies = {
             'd': []
             }
 
+    aug_t = make_augment_pipe().to(device)
+    # cuda events around augment_batch, read only when logged to not
+    # synchronize at each step. On cpu augment_batch is synchronous, it is
+    # timed with perf_counter
+    aug_events = []
+    aug_times = []
+
     for ep in range(args.epochs):
         total_ds_size = len(dataloader)
-        for i, (imgs, masks) in enumerate(dataloader):
-            netG.zero_grad()
-            netD.zero_grad()
-            optimG.zero_grad()
-            optimD.zero_grad()
-            lossG.zero_grad()
-            lossD.zero_grad()
-            lossTV.zero_grad()
-            lossVGG.zero_grad()
-
-            aug_t = AugmentPipe(
-                        xflip=1.,
-                        xint=0.75,
-                        brightness=0.75,
-                        contrast=0.75,
-                        hue=1.,
-                        saturation=0.75)
-
-            # meh, too many cats/splits
-            imgs_masks = torch.cat([imgs, masks], dim=1)
-            aug_imgs_masks = aug_t(imgs_masks)
-            aug_imgs, aug_masks = torch.split(aug_imgs_masks, [3,1], dim=1)
-            imgs = torch.cat([imgs, aug_imgs], dim=0)
-            masks = torch.cat([masks, aug_masks], dim=0)
-
-            imgs = imgs.cuda(gpu, non_blocking=True)
-            masks = masks.cuda(gpu, non_blocking=True)
+        for i, (indices, (imgs, masks)) in enumerate(zip(batch_indices, dataloader)):
+            indices = torch.tensor(indices)
+            imgs = imgs.to(device, non_blocking=True)
+            masks = masks.to(device, non_blocking=True)
+
+            if cuda:
+                aug_start = torch.cuda.Event(enable_timing=True)
+                aug_end = torch.cuda.Event(enable_timing=True)
+                aug_start.record()
+            else:
+                aug_start = time.perf_counter()
+            imgs, masks = augment_batch(aug_t, imgs, masks)
+            if cuda:
+                aug_end.record()
+                aug_events.append((aug_start, aug_end))
+            else:
+                aug_times.append((time.perf_counter() - aug_start)*1000)
 
             # change img range from [0,255] to [-1,+1]
             imgs = imgs / 127.5 - 1
             masks = masks / 1.
 
-            # forward G
-            emb_repr, coarse_out, refined_out = netG(imgs, masks)
-            reconstructed_coarses = coarse_out*masks + imgs*(1-masks)
-            reconstructed_imgs = refined_out*masks + imgs*(1-masks)
-
-            pos_neg_imgs = torch.cat([imgs, reconstructed_imgs], dim=0)
-            dmasks = torch.cat([masks, masks], dim=0)
-
-            # forward D
-            pred_pos_neg_imgs = netD(pos_neg_imgs, dmasks)
-            pred_pos_imgs, pred_neg_imgs = torch.chunk(pred_pos_neg_imgs, 2, dim=0)
-
-            # loss + backward D
-            loss_discriminator = lossD(pred_pos_imgs, pred_neg_imgs)
-            losses['d'] = loss_discriminator.item()
-
-            with amp.scale_loss(loss_discriminator, optimD) as scaled_loss:
-                scaled_loss.backward(retain_graph=True)
-            optimD.step()
-
-            netG.zero_grad()
-            netD.zero_grad()
-            optimG.zero_grad()
-            optimD.zero_grad()
-            lossG.zero_grad()
-            lossD.zero_grad()
-
-            # loss + backward G
-            pred_neg_imgs = netD(reconstructed_imgs, masks)
-            loss_generator = lossG(pred_neg_imgs)
-            loss_recon = lossRecon(imgs, coarse_out, refined_out, dmasks)
-            loss_tv = lossTV(refined_out)
-            loss_perc, loss_style = lossVGG(imgs, refined_out)
-            loss_perc *= 0.05
-            loss_style *= 40
-            loss_contra = lossContra(*emb_repr.chunk(2))
-            loss_gen_recon = loss_generator + loss_recon + \
-                    loss_tv + loss_perc + loss_style + loss_contra
-
-            losses['g'] = loss_generator.item()
-            losses['r'] = loss_recon.item()
-            losses['tv'] = loss_tv.item()
-            losses['perc'] = loss_perc.item()
-            losses['style'] = loss_style.item()
-            losses['contra'] = loss_contra.item()
-
-            with amp.scale_loss(loss_gen_recon, optimG) as scaled_loss:
-                scaled_loss.backward()
-            optimG.step()
+            losses, loss_gen_recon, pred_pos_neg_imgs, reconstructed_coarses, reconstructed_imgs = \
+                    train_step(netG, netD, optimG, optimD, criterions, precision, imgs, masks,
+                            args.accumulation_steps, indices)
 
             # every 100 img, print losses, update the graph, output an image as
             # example
             if i % args.screenstep == 0:
+                if aug_events:
+                    aug_events[-1][1].synchronize()
+                    aug_times = [start.elapsed_time(end) for start, end in aug_events]
+                    aug_events = []
+                aug_ms = np.mean(aug_times)
+                aug_times = []
                 logging.info(
                         f'[p#{rank}] epoch: {ep}/{args.epochs}' + \
                         f'\tstep: {i}/{total_ds_size}' + \
-                        f'\tloss: {loss_gen_recon.item()}'
+                        f'\tloss: {loss_gen_recon.item()}' + \
+                        f'\taugmentation: {aug_ms:.2f} ms/step'
                     )
 
             if rank == 0 and i % args.screenstep == 0:
@@ -250,26 +339,36 @@ def train(gpu, args):
                 checkpoint_coarse = ((reconstructed_coarses[0] + 1) * 127.5)
                 checkpoint_recon = ((reconstructed_imgs[0] + 1) * 127.5)
 
-                save_image(((imgs[0] + 1) * 127.5) / 255, f'{args.plots_dir}/orig_{i}.png')
-                save_image(checkpoint_coarse / 255, f'{args.plots_dir}/coarse_{i}.png')
-                save_image(checkpoint_recon / 255, f'{args.plots_dir}/recon_{i}.png')
-
-                save_image(((aug_imgs[-1] + 1) * 127.5) / 255, f'{args.plots_dir}/aug_{i}.png')
-                save_image(aug_checkpoint_coarse / 255, f'{args.plots_dir}/aug_coarse_{i}.png')
-                save_image(aug_checkpoint_recon / 255, f'{args.plots_dir}/aug_recon_{i}.png')
+                previews = {
+                        f'{args.plots_dir}/orig_{i}.png': ((imgs[0] + 1) * 127.5) / 255,
+                        f'{args.plots_dir}/coarse_{i}.png': checkpoint_coarse / 255,
+                        f'{args.plots_dir}/recon_{i}.png': checkpoint_recon / 255,
+                        f'{args.plots_dir}/aug_{i}.png': ((imgs[-1] + 1) * 127.5) / 255,
+                        f'{args.plots_dir}/aug_coarse_{i}.png': aug_checkpoint_coarse / 255,
+                        f'{args.plots_dir}/aug_recon_{i}.png': aug_checkpoint_recon / 255,
+                        }
 
                 # maybe save them in metrics.update()
-                torch.save(netG.state_dict(), f'{args.checkpoint_dir}/generator.pt')
-                torch.save(netD.state_dict(), f'{args.checkpoint_dir}/discriminator.pt')
-                torch.save(optimG.state_dict(), f'{args.checkpoint_dir}/opt_generator.pt')
-                torch.save(optimD.state_dict(), f'{args.checkpoint_dir}/opt_discriminator.pt')
+                checkpoint_writer.save(ep*total_ds_size + i, {
+                    'generator': netG.state_dict(),
+                    'discriminator': netD.state_dict(),
+                    'opt_generator': optimG.state_dict(),
+                    'opt_discriminator': optimD.state_dict(),
+                    }, previews)
             if rank == 0:
                 metrics.update(losses, pred_pos_neg_imgs, netG, netD)
-        torch.save(netG.state_dict(), f'{args.checkpoint_dir}/generator.pt')
-        torch.save(netD.state_dict(), f'{args.checkpoint_dir}/discriminator.pt')
-        torch.save(optimG.state_dict(), f'{args.checkpoint_dir}/opt_generator.pt')
-        torch.save(optimD.state_dict(), f'{args.checkpoint_dir}/opt_discriminator.pt')
+        if rank == 0:
+            # the step of the last batch, the state after it: (ep + 1)*total_ds_size
+            # is the first step of the next epoch and has its own checkpoint
+            checkpoint_writer.save((ep + 1)*total_ds_size - 1, {
+                'generator': netG.state_dict(),
+                'discriminator': netD.state_dict(),
+                'opt_generator': optimG.state_dict(),
+                'opt_discriminator': optimD.state_dict(),
+                })
         logging.info(f'[p#{rank}] training ended.')
+    if rank == 0:
+        checkpoint_writer.close()
     return
 
 if __name__ == '__main__':
@@ -281,14 +380,50 @@ if __name__ == '__main__':
     parser.add_argument("--nr", default=0, type=int, help="ranking within the nodes")
     parser.add_argument("--epochs", default=1, type=int, help="number of total epochs to run")
     parser.add_argument("--batch_size", default=2, type=int, help="batch size")
+    parser.add_argument("--accumulation_steps", default=1, type=int,
+            help="micro batches the batch is split in, their gradients are accumulated")
+    parser.add_argument("--contrastive_queue", default=0, type=int,
+            help="embeddings of the previous micro batches used as InfoNCE negatives")
+    parser.add_argument("--checkpointing", default=[], nargs='*', choices=checkpoint_segments,
+            help="segments of the generator recomputed in backward to save memory")
+    parser.add_argument("--attention", default='full', choices=SelfAttention.modes,
+            help="SelfAttention mode of the generator, sdpa needs less memory at large sizes")
+    parser.add_argument("--shared_vgg", action='store_true',
+            help="VGGLoss without graph for the real imgs, gradients go to the generated ones")
+    parser.add_argument("--vgg_gram_cache", default=0, type=int,
+            help="gram matrices of real imgs kept by VGGLoss with --shared_vgg (~2.4 MB each)")
     parser.add_argument("--input_size", default=256, type=int, help="size of the imgs")
     parser.add_argument("--learning_rate_g", default=0.0001, type=float, help="learning rate of the generator")
     parser.add_argument("--learning_rate_d", default=0.0004, type=float, help="learning rate of the discriminator")
-    parser.add_argument("--dataset_dir", type=str, help="dataset location", required=True)
+    parser.add_argument("--dataset_dir", type=str, help="dataset location, not needed with --shard_dir")
     parser.add_argument("--checkpoint_dir", type=str, help="where to load/save checkpoints", required=True)
     parser.add_argument("--plots_dir", type=str, help="where to save the plots", required=True)
     parser.add_argument("--video_dir", type=str, help="where to save the video", required=True)
+    parser.add_argument("--num_workers", default=4, type=int, help="processes loading the dataset")
+    parser.add_argument("--prefetch_factor", default=2, type=int, help="batches loaded in advance by each worker")
+    parser.add_argument("--cache_dataset", action='store_true', help="keep the decoded imgs in memory")
+    parser.add_argument("--keep_checkpoints", default=3, type=int, help="number of checkpoints kept")
+    parser.add_argument("--shard_dir", type=str, help="read the dataset from the shards of make_shards.py")
+    parser.add_argument("--device", default='cuda', choices=['cuda', 'cpu'],
+            help="train on the gpus or on cpu (one process per --gpus)")
+    parser.add_argument("--precision", default='fp16', choices=training_precisions,
+            help="fp16/bf16 use torch.autocast, apex the amp O2 of nvidia-apex")
     args = parser.parse_args()
+    if args.device == 'cpu' and args.precision == 'apex':
+        parser.error('apex needs --device cuda')
+    if args.vgg_gram_cache > 0 and not args.shared_vgg:
+        parser.error('--vgg_gram_cache needs --shared_vgg')
+    if args.keep_checkpoints < 1:
+        parser.error('--keep_checkpoints must be at least 1')
+    if args.batch_size % args.accumulation_steps != 0:
+        parser.error('--batch_size must be a multiple of --accumulation_steps')
+    if args.dataset_dir is None and args.shard_dir is None:
+        parser.error('one of --dataset_dir and --shard_dir is required')
+    if args.shard_dir is not None:
+        # the shards are already resized, only index.json is read here
+        _, h, w = ShardedFaceMaskDataset(args.shard_dir).img_shape
+        if (h, w) != (args.input_size, args.input_size):
+            parser.error(f'the imgs of --shard_dir are {h}x{w}, they do not match --input_size {args.input_size}')
 
     args.world_size = args.gpus*args.nodes
 
@@ -1,5 +1,9 @@
 #!/usr/bin/python3
 import os
+import atexit
+import threading
+from pathlib import Path
+from queue import Queue, Full
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
@@ -33,84 +37,266 @@ def resize_with_ratio(img, width=None, height=None, inter=cv2.INTER_AREA):
 
     return cv2.resize(img, dim, interpolation=inter)
 
+# Wrapper around a mediapipe FaceMesh graph. Building the graph and parsing
+# landmarks_list.txt is way more expensive than the landmark inference itself,
+# so a detector is meant to be created once and reused over many images.
+# FaceMesh is not thread safe: process() is serialised by a lock, threads that
+# run in parallel should each use their own detector (see get_detector).
+class LandmarkDetector:
+    def __init__(self, static_image_mode=True, max_num_faces=1,
+            landmarks_file=f'{curr_dir}/landmarks_list.txt'):
+        self.static_image_mode = static_image_mode
+        self.max_num_faces = max_num_faces
+        with open(landmarks_file, 'r') as f:
+            self.landmarks_list = [int(i) for i in f.readline().strip().split(',')]
+        self.face_mesh = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.face_mesh is None:
+            self.face_mesh = mp.solutions.face_mesh.FaceMesh(
+                    static_image_mode=self.static_image_mode,
+                    max_num_faces=self.max_num_faces)
+        return self
+
+    def close(self):
+        if self.face_mesh is not None:
+            self.face_mesh.close()
+            self.face_mesh = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # run the raw FaceMesh graph over img (no color conversion is applied),
+    # return the landmarks of the first face found or None
+    def process(self, img):
+        with self.lock:
+            self.open()
+            results = self.face_mesh.process(img)
+        if not results.multi_face_landmarks:
+            return None
+        return results.multi_face_landmarks[0]
+
+    # return the keypoints of the polygon which contain the surgical mask
+    def find_facial_landmarks(self, img, debug=False):
+        keypoints = []
+
+        imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        faceLms = self.process(imgRGB)
+        if faceLms is not None:
+            ih,iw,ic = img.shape
+
+            for landmark in self.landmarks_list:
+                xc = int(faceLms.landmark[landmark].x*iw)
+                yc = int(faceLms.landmark[landmark].y*ih)
+
+                if not landmark in fixed_landmarks:
+                    yc += 40
+                else:
+                    yc -= 10
+                keypoints.append((xc, yc))
+        if debug:
+            img_land = img.copy()
+            if faceLms is not None:
+                mpDraw = mp.solutions.drawing_utils
+                drawSpec = mpDraw.DrawingSpec(thickness=1, circle_radius=1)
+                mpDraw.draw_landmarks(img_land, faceLms,
+                        mp.solutions.face_mesh.FACEMESH_CONTOURS, drawSpec, drawSpec)
+            cv2.imshow('landmarks', img_land)
+            cv2.waitKey(0)
+        return keypoints
+
+# process-wide pool of detectors, one for each thread and configuration, they
+# are closed at interpreter exit
+_detectors = dict()
+_detectors_lock = threading.Lock()
+
+def get_detector(static_image_mode=True, max_num_faces=1):
+    key = (threading.get_ident(), static_image_mode, max_num_faces)
+    with _detectors_lock:
+        if key not in _detectors:
+            _detectors[key] = LandmarkDetector(static_image_mode, max_num_faces).open()
+        return _detectors[key]
+
+def close_detectors():
+    with _detectors_lock:
+        for detector in _detectors.values():
+            detector.close()
+        _detectors.clear()
+
+atexit.register(close_detectors)
+
 # keypoint detection
-def find_facial_landmarks(img, landmarks=[], debug=False):
-
-    with open(f'{curr_dir}/landmarks_list.txt', 'r') as f:
-        landmarks_list = [int(i) for i in f.readline().strip().split(',')]
-
-    keypoints = []
-
-    mpDraw = mp.solutions.drawing_utils
-    mpFaceMesh = mp.solutions.face_mesh
-    faceMesh = mpFaceMesh.FaceMesh(max_num_faces=1)
-    drawSpec = mpDraw.DrawingSpec(thickness=1, circle_radius=1)
-
-    imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    results = faceMesh.process(imgRGB)
-    img_land = img.copy()
-    if results.multi_face_landmarks:
-        for faceLms in results.multi_face_landmarks:
-            mpDraw.draw_landmarks(img_land,
-                    faceLms, mpFaceMesh.FACEMESH_CONTOURS, drawSpec, drawSpec)
-            #for id,lm in enumerate(faceLms.landmark):
-            #    print(lm)
-            #    ih, iw, ic = img.shape
-            #    x,y = int(lm.x*iw), int(lm.y*ih)
-            #    print(id, x,y)
-        ih,iw,ic = img.shape
-
-        for landmark in landmarks_list:
-            xc = int(faceLms.landmark[landmark].x*iw)
-            yc = int(faceLms.landmark[landmark].y*ih)
-
-            if not landmark in fixed_landmarks:
-                yc += 40
-            else:
-                yc -= 10
-            keypoints.append((xc, yc))
-    if debug:
-        cv2.imshow('landmarks', img_land)
-        cv2.waitKey(0)
-    return keypoints
+def find_facial_landmarks(img, landmarks=[], debug=False, detector=None):
+    if detector is None:
+        detector = get_detector()
+    return detector.find_facial_landmarks(img, debug=debug)
+
+# Weighted k-means (k-means++ init) over the populated cells of a 3-D color
+# histogram: cells are 2**(8-hist_bits) wide on each channel and are
+# represented by the mean color of their pixels. Return the centers and the
+# label of each cell.
+def histogram_kmeans(colors, weights, bins, attempts=3, max_iter=10, eps=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    best = None
+    for _ in range(attempts):
+        centers = colors[[rng.choice(len(colors), p=weights/weights.sum())]]
+        for _ in range(1, bins):
+            dist = ((colors[:, None] - centers[None])**2).sum(-1).min(1)*weights
+            if dist.sum() == 0:
+                centers = np.concatenate([centers, centers[:1]])
+                continue
+            centers = np.concatenate([centers, colors[[rng.choice(len(colors), p=dist/dist.sum())]]])
+
+        for _ in range(max_iter):
+            dist = ((colors[:, None] - centers[None])**2).sum(-1)
+            label = dist.argmin(1)
+            count = np.bincount(label, weights, minlength=bins)
+            new_centers = np.stack([np.bincount(label, weights*colors[:, c], minlength=bins)
+                for c in range(3)], axis=1)
+            new_centers = np.where(count[:, None] > 0,
+                    new_centers/np.maximum(count, 1)[:, None], centers)
+            shift = np.abs(new_centers - centers).max()
+            centers = new_centers
+            if shift < eps:
+                break
+
+        dist = ((colors[:, None] - centers[None])**2).sum(-1)
+        label = dist.argmin(1)
+        compactness = (dist[np.arange(len(colors)), label]*weights).sum()
+        if best is None or compactness < best[0]:
+            best = (compactness, centers, label)
+    return best[1], best[2]
 
 # color quantization on img with fixed number of bins
-def color_quantization(img, bins=2, debug=False):
-    Z = img.reshape((-1, 3))
-    Z = np.float32(Z)
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
-    ret, label, center = cv2.kmeans(Z, bins, None,
-            criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
-
-    center = np.uint8(center)
-    count_color = [0 for _ in range(bins)]
-
-    for elem in label:
-        count_color[elem[0]] += 1
+# method='kmeans' clusters every pixel of img with cv2.kmeans, while
+# method='histogram' clusters only the pixels inside roi (a boolean mask, the
+# whole image if None) with histogram_kmeans, pixels outside roi are set to 0
+def color_quantization(img, bins=2, debug=False, method='kmeans', roi=None, hist_bits=5):
+    if method == 'kmeans':
+        Z = img.reshape((-1, 3))
+        Z = np.float32(Z)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+        ret, label, center = cv2.kmeans(Z, bins, None,
+                criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+
+        center = np.uint8(center)
+        label = label.flatten()
+        count_color = np.bincount(label, minlength=bins)
+        res2 = center[label].reshape((img.shape))
+    elif method == 'histogram':
+        if roi is None:
+            roi = np.ones(img.shape[:2], bool)
+        pixels = img[roi]
+        res2 = np.zeros_like(img)
+        if len(pixels) == 0:
+            return res2, np.zeros(3, np.uint8)
+
+        # index of the histogram cell of each pixel
+        shift = 8 - hist_bits
+        cells = pixels >> shift
+        cell = (cells[:, 0].astype(np.int64) << (2*hist_bits)) | \
+                (cells[:, 1].astype(np.int64) << hist_bits) | cells[:, 2]
+        cell_ids, cell_of_pixel, cell_count = np.unique(cell,
+                return_inverse=True, return_counts=True)
+        cell_count = cell_count.astype(np.float64)
+        cell_colors = np.stack([np.bincount(cell_of_pixel, pixels[:, c], len(cell_ids))
+            for c in range(3)], axis=1) / cell_count[:, None]
+
+        center, cell_label = histogram_kmeans(cell_colors, cell_count, bins)
+        center = np.uint8(center)
+        count_color = np.bincount(cell_label, cell_count, minlength=bins)
+        res2[roi] = center[cell_label[cell_of_pixel]]
+    else:
+        raise ValueError(f'unknown color quantization method {method}')
+
     index_list = np.argsort(count_color)
     reference = center[index_list[-1]]
     if (reference == [0, 0, 0]).all():
        reference = center[index_list[-2]]
 
-    res = center[label.flatten()]
-    res2 = res.reshape((img.shape))
     if debug:
         cv2.imshow('kmeans', res2)
         cv2.waitKey(0)
     return res2, reference
 
+# Erosion/dilation of a binary img (0 and one other value) as iterations
+# passes of a 3x3 square kernel.
+# method='iterative' runs them one by one, 'rect' runs a single pass of a
+# (2*iterations+1) square kernel and 'distance' thresholds the chessboard
+# distance transform, they all give the same result.
+def erode(img, iterations, method='iterative'):
+    if method == 'iterative':
+        return cv2.erode(img, np.ones((3, 3), np.uint8), iterations=iterations)
+    if method == 'rect':
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT,
+                (2*iterations+1, 2*iterations+1))
+        return cv2.erode(img, kernel)
+    if method == 'distance':
+        dist = cv2.distanceTransform(img, cv2.DIST_C, 3)
+        return (dist > iterations).astype(img.dtype) * img.max()
+    raise ValueError(f'unknown morphology method {method}')
+
+def dilate(img, iterations, method='iterative'):
+    if method == 'iterative':
+        return cv2.dilate(img, np.ones((3, 3), np.uint8), iterations=iterations)
+    if method == 'rect':
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT,
+                (2*iterations+1, 2*iterations+1))
+        return cv2.dilate(img, kernel)
+    if method == 'distance':
+        dist = cv2.distanceTransform(np.uint8(img == 0), cv2.DIST_C, 3)
+        return (dist <= iterations).astype(img.dtype) * img.max()
+    raise ValueError(f'unknown morphology method {method}')
+
+# closing, erosion and dilation applied by find_mask to the thresholded img
+def mask_morphology(thresh, method='iterative'):
+    # closing, already a single pass
+    closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+
+    # Erosion
+    eroded = erode(closing, 5, method)
+
+    # dilation
+    dilated = dilate(eroded, 8, method)
+    return closing, eroded, dilated
+
+# Bounding rectangle (x0, y0, x1, y1) of the keypoints enlarged by pad pixels
+# on each side and clipped to the image
+def roi_rect(keypoints, shape, pad):
+    x, y, w, h = cv2.boundingRect(np.array(keypoints, np.int32))
+    return max(x - pad, 0), max(y - pad, 0), \
+            min(x + w + pad, shape[1]), min(y + h + pad, shape[0])
+
+# padding of the find_mask crop: reach of the 5x5 blur, of the closing and of
+# the 8 dilations plus one pixel, so the crop border is always background
+roi_pad = 2 + 1 + 8 + 1
+
 # Function that given an img return a binary mask (np.array) of the surgical
 # mask detected in the image img. If facial landmarks are not detected, return
 # an empty np.array.
-def find_mask(img, debug=False, save_mask=None):
+def find_mask(img, debug=False, save_mask=None, detector=None, quantization='kmeans',
+        morphology='iterative'):
 
     # Keypoints detection
-    keypoints = find_facial_landmarks(img, debug=debug)
+    keypoints = find_facial_landmarks(img, debug=debug, detector=detector)
     if not keypoints:
         return np.array([])
+    # Everything after the landmarks runs only inside the bounding rectangle
+    # of the polygon, padded so that the blur and the morphology never see
+    # the border of the crop. The result is then pasted in a full size mask.
+    full_mask = np.zeros(img.shape[:2], np.uint8)
+    x0, y0, x1, y1 = roi_rect(keypoints, img.shape, roi_pad)
+    if x1 <= x0 or y1 <= y0:
+        return full_mask
+    img = img[y0:y1, x0:x1]
+
     # Creating mask to isolate surgical mask area
     mask = np.zeros(img.shape[:2], np.uint8)
-    cv2.fillPoly(mask, np.array([keypoints]), (255, 255, 255))
+    cv2.fillPoly(mask, np.array([keypoints]) - [x0, y0], (255, 255, 255))
     out = cv2.bitwise_and(img, img, mask=mask)
     not_black_pxl = np.any(out != [0, 0, 0], axis=-1)
 
@@ -118,8 +304,12 @@ def find_mask(img, debug=False, save_mask=None):
     img = cv2.GaussianBlur(out, (5, 5), 0)
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
 
-    # Apply kmeans to find dominant color
-    res, reference = color_quantization(hsv, bins=3, debug=debug)
+    # Apply kmeans to find dominant color, over the whole image one of the
+    # clusters is spent on the black area outside the polygon while the
+    # histogram method sees only the pixels inside it
+    bins = 3 if quantization == 'kmeans' else 2
+    res, reference = color_quantization(hsv, bins=bins, debug=debug,
+            method=quantization, roi=not_black_pxl)
 
     # Thresholding
     res = res[:, :, 2]
@@ -135,15 +325,7 @@ def find_mask(img, debug=False, save_mask=None):
             255, cv2.THRESH_BINARY)
 
     thresh //= 255
-    # closing
-    kernel = np.ones((3, 3), np.uint8)
-    closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-
-    # Erosion
-    eroded = cv2.erode(closing, kernel, iterations=5)
-
-    # dilation
-    dilated = cv2.dilate(eroded, kernel, iterations=8)
+    closing, eroded, dilated = mask_morphology(thresh, morphology)
 
     if debug:
         cv2.imshow('polygon', mask)
@@ -170,6 +352,9 @@ def find_mask(img, debug=False, save_mask=None):
         cv2.imshow('dilated', dilated*255)
         cv2.waitKey(0)
 
+    full_mask[y0:y1, x0:x1] = dilated
+    dilated = full_mask
+
     if(save_mask is not None):
         print("Saving dilated image (binary mask)...")
         cv2.imwrite(save_mask, dilated*255)
@@ -177,6 +362,72 @@ def find_mask(img, debug=False, save_mask=None):
     return dilated
 
 
+# Decode the items in a background thread, keeping at most prefetch decoded
+# images in memory. Yield (item, img) in the same order of items.
+def prefetch_images(items, load=cv2.imread, prefetch=16):
+    queue = Queue(maxsize=prefetch)
+    stop = threading.Event()
+    end = object()
+
+    def put(elem):
+        while not stop.is_set():
+            try:
+                queue.put(elem, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in items:
+                if not put((item, load(item))):
+                    return
+        except Exception as e:
+            put((end, e))
+            return
+        put((end, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, img = queue.get()
+            if item is end:
+                if img is not None:
+                    raise img
+                return
+            yield item, img
+    finally:
+        stop.set()
+        thread.join()
+
+# Batched version of find_mask: images can be BGR np.array or paths to be read
+# with load. Images are decoded ahead of time while the masks are computed and
+# the masks are yielded as soon as they are ready, in the same order of images.
+# Images that can not be decoded yield an empty np.array like faces not found.
+def find_masks(images, detector=None, prefetch=16, load=cv2.imread, quantization='kmeans',
+        morphology='iterative'):
+    if detector is None:
+        detector = get_detector()
+
+    def decode(image):
+        return load(str(image)) if isinstance(image, (str, os.PathLike)) else image
+
+    for _, img in prefetch_images(images, decode, prefetch):
+        if img is None:
+            yield np.array([])
+            continue
+        yield find_mask(img, detector=detector, quantization=quantization,
+                morphology=morphology)
+
+# Yield (path, mask) for every image inside dirname matching pattern
+def find_masks_in_dir(dirname, pattern='*', detector=None, prefetch=16,
+        load=cv2.imread, quantization='kmeans', morphology='iterative'):
+    paths = sorted(f for f in Path(dirname).glob(pattern) if f.is_file())
+    return zip(paths, find_masks(paths, detector, prefetch, load, quantization, morphology))
+
+
 if __name__ == '__main__':
 
     # Read image
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+import os
+import sys
+import argparse
+from pathlib import Path
+import cv2
+import numpy as np
+import torch
+from torchvision import transforms as T
+from mask_detection import get_detector, find_mask, prefetch_images
+from warpface import warp_face
+
+curr_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f'{curr_dir}/gan_inpainting')
+from inference import load_network, infer, infer_crop, network_size
+
+def to_tensor(img):
+    return torch.from_numpy(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).permute(2, 0, 1)
+
+def to_image(tensor):
+    img = tensor.clamp(0, 255).round().byte().permute(1, 2, 0).cpu().numpy()
+    return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+# The whole pipeline of run.sh (main.py + inference.py) in a single process:
+# the landmark detector and the generator are loaded once and images and masks
+# are passed around as np.array/tensors instead of jpg files in output/.
+# With crop the output keeps the resolution of the input and the network runs
+# only around the mask, see inference.infer_crop
+class Pipeline:
+    def __init__(self, checkpoint_dir, size=256, detector=None, quantization='kmeans', crop=False):
+        self.size = size
+        self.crop = crop
+        self.detector = detector if detector is not None else get_detector()
+        self.quantization = quantization
+        self.netG = load_network(f'{checkpoint_dir}/generator.pt', fold=True)
+
+    # BGR face with the mask area set to 0 and the binary mask of the pixels
+    # to inpaint, like main.py does. mask is None if no face is found.
+    def prepare(self, front, lateral=None):
+        mask = find_mask(front, detector=self.detector, quantization=self.quantization)
+        if mask.size == 0:
+            return front, None
+        mask = mask[..., np.newaxis]
+
+        if lateral is None:
+            return (1-mask)*front, mask[..., 0]
+
+        warped = warp_face(front, lateral, detector=self.detector)
+        mask_warped = np.uint8(warped.sum(-1, keepdims=True) > 0)
+        mask_warped = (1-mask_warped)*mask
+
+        # put the warped face over the front one by following the mask
+        face = (1-mask)*front + mask*warped
+        return face, mask_warped[..., 0]
+
+    # inpaint the mask area of the BGR face, return a BGR image of network_size
+    # or of the size of face with crop
+    def inpaint(self, face, mask):
+        if self.crop:
+            if mask is None:
+                return face
+            with torch.inference_mode():
+                out_img = infer_crop(to_tensor(face), torch.from_numpy(mask[np.newaxis]*255),
+                        self.netG, self.size)
+            return to_image(out_img)
+
+        resize = T.Resize(network_size(*face.shape[:2], self.size))
+        img = resize(to_tensor(face))
+        if mask is None or not mask.any():
+            return to_image(img)
+
+        mask = resize(torch.from_numpy(mask[np.newaxis]*255))
+        with torch.inference_mode():
+            out_img = infer(img, mask, self.netG)
+        return to_image(out_img)
+
+    def __call__(self, front, lateral=None):
+        return self.inpaint(*self.prepare(front, lateral))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Remove the surgical mask from a list of images")
+    parser.add_argument("--input_front", type=str, nargs='+', help="The input images", required=True)
+    parser.add_argument("--input_lateral", type=str, nargs='*', default=[],
+            help="The reference images, one for each input image")
+    parser.add_argument("--output", type=str, help="Where to save the output image (single input)")
+    parser.add_argument("--output_dir", type=str, help="Where to save the output images, named as the inputs")
+    parser.add_argument("--checkpoint_dir", type=str, help="where to load checkpoints", required=True)
+    parser.add_argument("--size", default=256, type=int, help="size of the shorter side of the output")
+    parser.add_argument("--crop", action='store_true',
+            help="keep the input resolution and run the network only around the mask")
+    args = parser.parse_args()
+
+    if args.input_lateral and len(args.input_lateral) != len(args.input_front):
+        parser.error('--input_lateral must have one image for each --input_front')
+    if args.output is not None and len(args.input_front) > 1:
+        parser.error('--output can be used with a single input, use --output_dir')
+    if args.output is None and args.output_dir is None:
+        parser.error('one of --output or --output_dir is required')
+
+    print("Loading network...")
+    pipeline = Pipeline(args.checkpoint_dir, args.size, crop=args.crop)
+
+    laterals = args.input_lateral or [None]*len(args.input_front)
+    def load(paths):
+        front, lateral = paths
+        return cv2.imread(front), None if lateral is None else cv2.imread(lateral)
+
+    for (front_path, _), (front, lateral) in prefetch_images(zip(args.input_front, laterals), load):
+        if front is None:
+            print(f'[ERROR] Unable to read {front_path}')
+            continue
+        result = pipeline(front, lateral)
+        output = args.output or f'{args.output_dir}/{Path(front_path).stem}.jpg'
+        cv2.imwrite(output, result)
+        print(f'{front_path} -> {output}')
@@ -4,18 +4,20 @@ import cv2
 import numpy as np
 import os
 import csv
-from mask_detection import find_facial_landmarks, get_image
+import time
+import argparse
+import multiprocessing as mp
+from mask_detection import find_facial_landmarks, get_image, get_detector, dilate
 from pathlib import Path
 from PIL import Image
 
-def create_mask(img, debug=False):
-    keypoints = find_facial_landmarks(img)
+def create_mask(img, debug=False, detector=None, morphology='iterative'):
+    keypoints = find_facial_landmarks(img, detector=detector)
     mask = np.zeros(img.shape[:2], np.uint8)
     if len(keypoints) == 0:
         return None
     cv2.fillPoly(mask, np.array([keypoints]), (255, 255, 255))
-    kernel = np.ones((3, 3), np.uint8)
-    mask =  cv2.dilate(mask, kernel, iterations=10)
+    mask = dilate(mask, 10, morphology)
     if debug:
         cv2.imshow('mask',mask)
         cv2.waitKey(0)
@@ -35,25 +37,107 @@ def get_photos(pathname):
 
     return sorted(photos)
 
+def mask_path(root, photo):
+    return Path(root) / 'masked_images' / photo.parent.name / photo.name
+
+def csv_row(photo, path_to_mask):
+    return [photo.name.split(".")[0], str(photo.absolute()), str(path_to_mask.absolute())]
+
+# photos without a mask (no face found or not readable) are listed in this
+# file next to the csv, one path per line, the csv keeps only valid rows
+def skipped_path(csv_path):
+    return csv_path.with_name(f'{csv_path.stem}_skipped.txt')
+
+# read the rows already written in the csv and the photos skipped, used to
+# resume an interrupted run
+def read_done(csv_path):
+    done = set()
+    if csv_path.exists():
+        with open(csv_path, 'r', newline='') as f:
+            done |= {row[1] for row in csv.reader(f) if len(row) == 3}
+    if skipped_path(csv_path).exists():
+        with open(skipped_path(csv_path), 'r') as f:
+            done |= {line.rstrip('\n') for line in f if line.strip()}
+    return done
+
+def init_worker():
+    # each worker keep its own landmark detector for the whole run
+    get_detector()
+
+# run in the worker processes, return the csv row or None if no face is found
+def process_photo(job):
+    photo, path_to_mask = job
+    if not path_to_mask.exists():
+        img = cv2.imread(str(photo))
+        if img is None:
+            return None
+        mask = create_mask(img, False)
+        if mask is None:
+            return None
+        cv2.imwrite(str(path_to_mask), mask)
+    return csv_row(photo, path_to_mask)
+
+# Build the masks for every photo inside pathname/FFHQ/*/*, fanning out the
+# work to a pool of processes. The rows of the csv are written by this process
+# only, in the same order of the photos, and flushed as soon as they are ready
+# so an interrupted run can be resumed by simply running it again.
+def build_dataset(pathname, workers=os.cpu_count(), csv_name='maskffhq.csv',
+        chunksize=8, report_every=500):
+    root = Path(pathname)
+    csv_path = root / csv_name
+    done = read_done(csv_path)
+
+    jobs = [(photo, mask_path(root, photo)) for photo in get_photos(f'{root}/')
+            if str(photo.absolute()) not in done]
+    print(f'{len(done)} photos already done or skipped, {len(jobs)} to process with {workers} workers')
+
+    processed, not_found = 0, 0
+    start = time.perf_counter()
+    with open(csv_path, 'a', newline='') as csvf, open(skipped_path(csv_path), 'a') as skippedf, \
+            mp.Pool(workers, initializer=init_worker) as pool:
+        writer = csv.writer(csvf)
+        for (photo, _), row in zip(jobs, pool.imap(process_photo, jobs, chunksize)):
+            processed += 1
+            if row is None:
+                not_found += 1
+                print(f"Face not found for {photo}")
+                skippedf.write(f'{photo.absolute()}\n')
+                skippedf.flush()
+            else:
+                writer.writerow(row)
+                csvf.flush()
+            if processed % report_every == 0 or processed == len(jobs):
+                elapsed = time.perf_counter() - start
+                print(f'[{processed}/{len(jobs)}] {processed/elapsed:.2f} images/s' + \
+                        f'\tfaces not found: {not_found}')
+    return processed, not_found
+
 if __name__ == '__main__':
-    pathname = Path(sys.argv[1])
-    split_folder = sys.argv[1].split('/')
-    subfolder = split_folder[-2]
-    filename = split_folder[-1]
-    csvf = open(f'{pathname.parent.parent.parent}/maskffhq.csv', 'a')
-    path_to_mask = Path(f'{pathname.parent.parent.parent}' + \
-            f'/masked_images/{subfolder}/{filename}')
+    parser = argparse.ArgumentParser(description="Create the masks of the FFHQ dataset")
+    parser.add_argument("path", type=str,
+            help="the dataset root (containing FFHQ/) or a single photo in FFHQ/<dir>/")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=8, help="photos sent to a worker at a time")
+    parser.add_argument("--csv", type=str, default='maskffhq.csv', help="name of the csv inside the dataset root")
+    args = parser.parse_args()
+
+    pathname = Path(args.path)
+    if pathname.is_dir():
+        build_dataset(pathname, args.workers, args.csv, args.chunksize)
+        exit(0)
+
+    root = pathname.parent.parent.parent
+    path_to_mask = mask_path(root, pathname)
     path_to_mask.parent.mkdir(parents=True, exist_ok=True)
 
     if path_to_mask.exists():
         exit(0)
 
-    img = cv2.imread(str(pathname))
-
-    mask = create_mask(img, False)
-    if mask is not None:
-        cv2.imwrite(str(path_to_mask), mask)
-        csvf.write(f'{filename.split(".")[0]},{pathname.absolute()},{path_to_mask.absolute()}\n')
-        csvf.close()
+    row = process_photo((pathname, path_to_mask))
+    if row is not None:
+        with open(root / args.csv, 'a', newline='') as csvf:
+            csv.writer(csvf).writerow(row)
     else:
         print(f"Face not found for {pathname}")
+        with open(skipped_path(root / args.csv), 'a') as skippedf:
+            skippedf.write(f'{pathname.absolute()}\n')
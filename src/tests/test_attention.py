@@ -0,0 +1,34 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from layers import SelfAttention, random_statistics
+
+@pytest.mark.parametrize('mode', ['chunked', 'sdpa'])
+def test_attention_modes_same_gradients(mode):
+    torch.manual_seed(0)
+    nets = [random_statistics(SelfAttention(64), attention_gamma=0.5), SelfAttention(64, mode, chunk_size=100)]
+    nets[1].load_state_dict(nets[0].state_dict())
+    x = torch.randn((2, 64, 24, 24))
+    inputs = [x.clone().requires_grad_() for _ in nets]
+
+    # the numel of every tensor saved for backward
+    saved = []
+    def pack(t):
+        saved.append(t.numel())
+        return t
+    outs = []
+    for net, input in zip(nets, inputs):
+        saved.clear()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = net(input)
+        out.square().mean().backward()
+        outs.append(out)
+    assert torch.allclose(outs[0], outs[1], atol=1e-5)
+    assert torch.allclose(inputs[0].grad, inputs[1].grad, atol=1e-5)
+    for a, b in zip(nets[0].parameters(), nets[1].parameters()):
+        assert torch.allclose(a.grad, b.grad, atol=1e-5)
+    # no (H*W)x(H*W) attention matrix is kept for backward, not even in chunks
+    assert sum(n for n in saved if n >= 2*100*24*24) == 0
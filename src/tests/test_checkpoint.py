@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+import pytest
+import torch
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from checkpoint import CheckpointWriter
+
+def test_checkpoint_rotation(tmp_path):
+    net = torch.nn.Linear(4, 2)
+    optim = torch.optim.Adam(net.parameters())
+    net(torch.ones(1, 4)).sum().backward()
+    optim.step()
+
+    writer = CheckpointWriter(str(tmp_path), keep=2)
+    for step in range(5):
+        with torch.no_grad():
+            net.weight.fill_(step)
+        writer.save(step, {'generator': net.state_dict(), 'opt_generator': optim.state_dict()},
+                {str(tmp_path / f'preview_{step}.png'): torch.rand((3, 8, 8))})
+        # the snapshot is taken in save, later updates are not in the checkpoint
+        with torch.no_grad():
+            net.weight.fill_(-1)
+        # wait for the write, otherwise the pending checkpoint can be dropped
+        writer.pending.join()
+    writer.close()
+    files = sorted(os.listdir(tmp_path))
+
+    assert [f for f in files if f.startswith('generator')] == \
+            ['generator.pt', 'generator_00000003.pt', 'generator_00000004.pt']
+    assert [f for f in files if f.startswith('opt_generator')] == \
+            ['opt_generator.pt', 'opt_generator_00000003.pt', 'opt_generator_00000004.pt']
+    assert not [f for f in files if f.endswith('.tmp')]
+    assert len([f for f in files if f.startswith('preview')]) == 5
+
+    state = torch.load(tmp_path / 'generator.pt')
+    assert torch.all(state['weight'] == 4)
+    assert torch.load(tmp_path / 'opt_generator.pt')['state'][0]['exp_avg'].shape == (2, 4)
+
+def test_checkpoint_dropped(tmp_path):
+    writer = CheckpointWriter(str(tmp_path), keep=3)
+    # the thread is kept busy writing the first checkpoint
+    started, release = threading.Event(), threading.Event()
+    write = writer.write
+    def slow_write(*job):
+        started.set()
+        release.wait()
+        write(*job)
+    writer.write = slow_write
+
+    writer.save(0, {'generator': {'step': torch.tensor(0)}})
+    started.wait()
+    for step in range(1, 4):
+        writer.save(step, {'generator': {'step': torch.tensor(step)}})
+    release.set()
+    # steps 1 and 2 are dropped, join must not wait for them
+    joined = threading.Thread(target=writer.pending.join, daemon=True)
+    joined.start()
+    joined.join(timeout=10)
+    assert not joined.is_alive()
+    writer.close()
+
+    assert sorted(os.listdir(tmp_path)) == ['generator.pt', 'generator_00000000.pt', 'generator_00000003.pt']
+    assert torch.load(tmp_path / 'generator.pt')['step'] == 3
+
+def test_checkpoint_keep_at_least_one(tmp_path):
+    with pytest.raises(ValueError):
+        CheckpointWriter(str(tmp_path), keep=0)
@@ -0,0 +1,46 @@
+import os
+import sys
+import subprocess
+import pytest
+import torch
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from generator import MSSAGenerator
+from export import RefineGenerator, export_torchscript, export_onnx
+from inference import load_exported
+from layers import SelfAttention, fold_batch_norm, random_statistics
+
+@pytest.fixture(scope='module', params=SelfAttention.traceable_modes)
+def net(request):
+    torch.manual_seed(0)
+    netG = random_statistics(MSSAGenerator(input_size=256, attention=request.param), attention_gamma=0.5)
+    return RefineGenerator(fold_batch_norm(netG)).eval()
+
+@pytest.mark.parametrize('export, filename', [
+    (export_torchscript, 'generator.pt'),
+    (export_onnx, 'generator.onnx'),
+    ])
+def test_export_parity(net, export, filename, tmp_path):
+    if filename.endswith('.onnx'):
+        pytest.importorskip('onnx')
+        pytest.importorskip('onnxruntime')
+    path = str(tmp_path / filename)
+    export(net, path)
+    exported = load_exported(path)
+
+    torch.manual_seed(1)
+    # different batch and size from the ones used to export
+    imgs = torch.rand((2, 3, 320, 256))*2 - 1
+    masks = (torch.rand((2, 1, 320, 256)) > 0.5).float()
+    with torch.no_grad():
+        expected = net(imgs, masks)
+    _, _, refined = exported(imgs, masks)
+    assert torch.allclose(refined, expected, atol=1e-5)
+
+# the chunk loop of the chunked attention would be fixed to the example size
+def test_export_rejects_chunked(tmp_path):
+    export = f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting/export.py'
+    result = subprocess.run([sys.executable, export, '--checkpoint_dir', str(tmp_path),
+        '--output', str(tmp_path / 'generator.pt'), '--attention', 'chunked'], capture_output=True, text=True)
+    assert result.returncode == 2
+    assert '--attention chunked can not be traced' in result.stderr
@@ -0,0 +1,33 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from generator import MSSAGenerator
+from layers import fuse_multi_dilation_state_dict, random_statistics
+from export import strip_data_parallel
+
+# a checkpoint saved by training.py has the module. prefix of DataParallel/DDP,
+# inference.load_network loads it in a wrapped fused generator
+@pytest.mark.parametrize('wrapped', [True, False])
+def test_fuse_multi_dilation_state_dict(wrapped):
+    torch.manual_seed(0)
+    netG = torch.nn.DataParallel(random_statistics(MSSAGenerator(input_size=256, cnum=4)))
+    state_dict = netG.state_dict()
+    assert any('.branch1.gate.' in k for k in state_dict)
+
+    fused = MSSAGenerator(input_size=256, cnum=4, fused_dilation=True)
+    if wrapped:
+        fused = torch.nn.DataParallel(fused)
+    else:
+        state_dict = strip_data_parallel(state_dict)
+    fused.load_state_dict(fuse_multi_dilation_state_dict(state_dict))
+
+    netG.eval()
+    fused.eval()
+    imgs = torch.rand((2, 3, 256, 256))*2 - 1
+    masks = torch.randint(0, 2, (2, 1, 256, 256)).float()
+    with torch.no_grad():
+        for a, b in zip(netG(imgs, masks), fused(imgs, masks)):
+            assert torch.allclose(a, b, atol=1e-5)
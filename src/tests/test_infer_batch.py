@@ -0,0 +1,33 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from inference import infer_batch
+
+def batch(mask_pixels):
+    torch.manual_seed(0)
+    imgs = torch.randint(0, 256, (len(mask_pixels), 3, 16, 16)).float()
+    masks = torch.zeros((len(mask_pixels), 1, 16, 16))
+    for i, pixels in enumerate(mask_pixels):
+        masks[i].view(-1)[:pixels] = 255
+    return imgs, masks
+
+@pytest.mark.parametrize('mask_pixels, min_mask_pixels, batch_sizes', [
+    ([0, 0, 0], 1, []),
+    ([10, 0, 20, 0], 1, [2]),
+    ([10, 3, 20], 5, [2]),
+    ([10, 3, 20], 1, [3]),
+    ])
+def test_infer_batch_skips_empty_masks(mask_pixels, min_mask_pixels, batch_sizes, fake_generator):
+    imgs, masks = batch(mask_pixels)
+    netG = fake_generator
+    out_imgs = infer_batch(imgs, masks, netG, min_mask_pixels)
+    assert netG.batch_sizes == batch_sizes
+    for img, mask, out_img, pixels in zip(imgs, masks, out_imgs, mask_pixels):
+        if pixels < min_mask_pixels:
+            assert torch.equal(out_img, img)
+        else:
+            assert torch.all(out_img[:, mask[0] > 0] == 127.5)
+            assert torch.allclose(out_img[:, mask[0] == 0], img[:, mask[0] == 0], atol=1e-4)
@@ -0,0 +1,40 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from generator import MSSAGenerator
+from inference import crop_window, infer_crop
+
+def box_mask(height, width, top, left, bottom, right):
+    mask = torch.zeros((1, height, width), dtype=torch.uint8)
+    mask[:, top:bottom, left:right] = 255
+    return mask
+
+@pytest.mark.parametrize('box, window', [
+    # small mask: size pixels around its center
+    ((700, 300, 780, 400), (612, 222, 256, 256)),
+    # large mask: context times the bbox
+    ((600, 250, 800, 550), (400, 100, 600, 600)),
+    # near the border: moved inside the image
+    ((1000, 0, 1024, 40), (768, 0, 256, 256)),
+    # larger than the image: clipped
+    ((0, 0, 1024, 768), (0, 0, 1024, 768)),
+    ])
+def test_crop_window(box, window):
+    assert crop_window(box_mask(1024, 768, *box)) == window
+
+def test_crop_window_empty():
+    assert crop_window(torch.zeros((1, 64, 64), dtype=torch.uint8)) is None
+
+@pytest.mark.parametrize('box', [(700, 300, 780, 400), (100, 100, 600, 700)])
+def test_infer_crop_keeps_unmasked_pixels(box):
+    torch.manual_seed(0)
+    netG = MSSAGenerator(input_size=256).eval()
+    img = torch.randint(0, 256, (3, 1024, 768), dtype=torch.uint8)
+    mask = box_mask(1024, 768, *box)
+    with torch.inference_mode():
+        out_img = infer_crop(img, mask, netG)
+    assert out_img.shape == img.shape
+    assert torch.equal(out_img[:, mask[0] == 0], img[:, mask[0] == 0].float())
@@ -0,0 +1,42 @@
+import numpy as np
+import cv2
+import pytest
+from numpy.testing import assert_array_equal
+from mask_detection import erode, dilate, mask_morphology
+
+def random_mask(shape, seed):
+    # blobs of different sizes, some of them touching the image border
+    rng = np.random.default_rng(seed)
+    img = (rng.random(shape) > 0.97).astype(np.uint8)
+    img = cv2.dilate(img, np.ones((5, 5), np.uint8))
+    img[rng.random(shape) > 0.99] = 0
+    img[:3, :shape[1]//3] = 1
+    return img
+
+@pytest.mark.parametrize('method', ['rect', 'distance'])
+@pytest.mark.parametrize('shape', [(1, 1), (7, 5), (64, 64), (120, 200)])
+def test_erode_dilate(method, shape):
+    for seed in range(3):
+        img = random_mask(shape, seed)
+        for iterations in [1, 2, 5, 8, 10]:
+            assert_array_equal(erode(img, iterations, method), erode(img, iterations))
+            assert_array_equal(dilate(img, iterations, method), dilate(img, iterations))
+
+@pytest.mark.parametrize('method', ['rect', 'distance'])
+def test_erode_dilate_constant(method):
+    for value in [0, 1]:
+        img = np.full((32, 48), value, np.uint8)
+        assert_array_equal(erode(img, 5, method), erode(img, 5))
+        assert_array_equal(dilate(img, 8, method), dilate(img, 8))
+
+@pytest.mark.parametrize('method', ['rect', 'distance'])
+def test_mask_morphology(method):
+    img = random_mask((240, 320), 0)
+    for expected, result in zip(mask_morphology(img), mask_morphology(img, method)):
+        assert_array_equal(result, expected)
+
+@pytest.mark.parametrize('method', ['rect', 'distance'])
+def test_dilate_255(method):
+    # create_mask dilates a 0/255 polygon
+    img = random_mask((240, 320), 1)*255
+    assert_array_equal(dilate(img, 10, method), dilate(img, 10))
@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import base64
+import threading
+import urllib.request
+import torch
+from torchvision.io import ImageReadMode, decode_image, encode_png
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from server import DynamicBatcher, make_server
+
+def request(height=16, width=16):
+    img = torch.randint(0, 256, (3, height, width), dtype=torch.uint8)
+    mask = torch.zeros((1, height, width), dtype=torch.uint8)
+    mask[:, :height//2] = 255
+    return img, mask
+
+def test_dynamic_batcher_max_batch_size(fake_generator):
+    netG = fake_generator
+    # the wait is long enough for all the requests to be queued
+    batcher = DynamicBatcher(netG, max_batch_size=4, max_wait_ms=500)
+    requests = [request() for _ in range(5)]
+    futures = [batcher.submit(img, mask) for img, mask in requests]
+    out_imgs = [f.result(timeout=10) for f in futures]
+
+    # 4 as soon as they are there, the last one after max_wait_ms
+    assert netG.batch_sizes == [4, 1]
+    for (img, mask), out_img in zip(requests, out_imgs):
+        assert out_img.dtype == torch.uint8
+        assert torch.all(out_img[:, mask[0] > 0] == 128)
+        assert torch.equal(out_img[:, mask[0] == 0], img[:, mask[0] == 0])
+
+    metrics = batcher.metrics.get_metrics(batcher.queue_depth())
+    assert metrics['queue_depth'] == 0
+    assert metrics['requests'] == 5
+    assert metrics['batch_size_histogram'] == {'1': 1, '4': 1}
+    assert metrics['latency_ms']['p50'] <= metrics['latency_ms']['p99']
+
+def test_dynamic_batcher_groups_by_shape(fake_generator):
+    netG = fake_generator
+    batcher = DynamicBatcher(netG, max_batch_size=8, max_wait_ms=200)
+    futures = [batcher.submit(*request(*size)) for size in [(16, 16), (16, 32), (16, 16)]]
+    out_imgs = [f.result(timeout=10) for f in futures]
+
+    assert netG.shapes == [(2, 3, 16, 16), (1, 3, 16, 32)]
+    assert [tuple(out_img.shape) for out_img in out_imgs] == [(3, 16, 16), (3, 16, 32), (3, 16, 16)]
+    assert batcher.metrics.get_metrics(0)['batch_size_histogram'] == {'1': 1, '2': 1}
+
+def test_server_keeps_aspect_ratio(fake_generator):
+    netG = fake_generator
+    server = make_server(netG, port=0, max_wait_ms=0, input_size=32)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        img, mask = request(200, 300)
+        body = json.dumps({
+            'image': base64.b64encode(encode_png(img).numpy().tobytes()).decode(),
+            'mask': base64.b64encode(encode_png(mask).numpy().tobytes()).decode(),
+            }).encode()
+        url = f'http://127.0.0.1:{server.server_address[1]}/infer'
+        with urllib.request.urlopen(urllib.request.Request(url, data=body), timeout=10) as response:
+            out_img = decode_image(torch.frombuffer(bytearray(response.read()), dtype=torch.uint8),
+                    ImageReadMode.RGB)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # shorter side of input_size, both multiple of 16
+    assert netG.shapes == [(1, 3, 32, 48)]
+    assert tuple(out_img.shape) == (3, 32, 48)
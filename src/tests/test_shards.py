@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+import torch
+from torchvision import transforms as T
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from dataset import FaceMaskDataset, ShardedFaceMaskDataset, synthetic_dataset
+from make_shards import make_shards
+
+@pytest.mark.parametrize('input_size, shard_size', [(64, 2), (40, 16)])
+def test_shards_match_dataset(input_size, shard_size, tmp_path):
+    synthetic_dataset(str(tmp_path), ['maskffhq.csv'], 5, 96)
+    make_shards(str(tmp_path), 'maskffhq.csv', str(tmp_path / 'shards'), input_size, shard_size)
+
+    dataset = FaceMaskDataset(str(tmp_path), 'maskffhq.csv', T.Resize((input_size, input_size)))
+    sharded = ShardedFaceMaskDataset(str(tmp_path / 'shards'))
+    assert len(sharded) == len(dataset)
+    for (img, mask), (sharded_img, sharded_mask) in zip(dataset, sharded):
+        assert torch.equal(sharded_img, img)
+        assert torch.equal(sharded_mask, mask)
@@ -0,0 +1,124 @@
+import os
+import sys
+import math
+import pytest
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from generator import MSSAGenerator, checkpoint_segments
+from discriminator import Discriminator
+from loss import GeneratorLoss, L1ReconLoss, TVLoss, DiscriminatorHingeLoss, VGGLoss, InfoNCE, info_nce
+from precision import TrainingPrecision
+from training import train_step, split_halves, join_halves
+
+@pytest.mark.parametrize('precision,batch_size,accumulation_steps',
+        [('fp32', 1, 1), ('bf16', 1, 1), ('fp32', 2, 2), ('fp32', 1, 2)])
+def test_train_step_cpu(precision, batch_size, accumulation_steps):
+    torch.manual_seed(0)
+    netG = MSSAGenerator(input_size=256, cnum=4)
+    netD = Discriminator(input_size=256, cnum=4)
+    optimG = torch.optim.Adam(netG.parameters(), lr=1e-4)
+    optimD = torch.optim.Adam(netD.parameters(), lr=1e-4)
+    criterions = (GeneratorLoss(), L1ReconLoss(), TVLoss(), DiscriminatorHingeLoss(),
+            VGGLoss('cpu', pretrained=False, shared=True, gram_cache_size=4), InfoNCE(queue_size=4))
+    # images followed by their augmented copies
+    imgs = torch.rand((2*batch_size, 3, 256, 256))*2 - 1
+    masks = torch.zeros((2*batch_size, 1, 256, 256))
+    masks[:, :, 96:160, 64:192] = 1
+
+    weightsG = [p.detach().clone() for p in netG.parameters()]
+    weightsD = [p.detach().clone() for p in netD.parameters()]
+    losses, _, pred_pos_neg_imgs, _, reconstructed_imgs = train_step(netG, netD, optimG, optimD,
+            criterions, TrainingPrecision(precision, 'cpu'), imgs, masks, accumulation_steps,
+            torch.arange(batch_size))
+
+    assert all(math.isfinite(v) for v in losses.values())
+    assert pred_pos_neg_imgs.dtype == torch.float32 and pred_pos_neg_imgs.shape[0] == 4*batch_size
+    assert torch.equal(reconstructed_imgs*(1-masks), imgs*(1-masks))
+    assert any(not torch.equal(a, b) for a, b in zip(weightsG, netG.parameters()))
+    assert any(not torch.equal(a, b) for a, b in zip(weightsD, netD.parameters()))
+    # the augmented copies are not cached
+    assert sorted(criterions[4].gram_cache) == list(range(batch_size))
+    # the batch norms of G are updated once per micro batch
+    micro_batches = len(split_halves(imgs, accumulation_steps))
+    assert all(b.item() == micro_batches for name, b in netG.named_buffers()
+            if name.endswith('num_batches_tracked'))
+
+# comm hook that counts the buckets DDP all-reduces, with a single process the
+# all-reduce would leave the gradients as they are
+def count_allreduce(calls, bucket):
+    calls.append(bucket.index())
+    future = torch.futures.Future()
+    future.set_result(bucket.buffer())
+    return future
+
+def test_train_step_ddp_sync(tmp_path):
+    dist.init_process_group('gloo', init_method=f'file://{tmp_path}/store', rank=0, world_size=1)
+    try:
+        calls = {}
+        for accumulation_steps in [1, 2]:
+            torch.manual_seed(0)
+            netG = DDP(MSSAGenerator(input_size=256, cnum=4))
+            netD = DDP(Discriminator(input_size=256, cnum=4))
+            calls[accumulation_steps] = {'g': [], 'd': []}
+            netG.register_comm_hook(calls[accumulation_steps]['g'], count_allreduce)
+            netD.register_comm_hook(calls[accumulation_steps]['d'], count_allreduce)
+            optimG = torch.optim.Adam(netG.parameters(), lr=1e-4)
+            optimD = torch.optim.Adam(netD.parameters(), lr=1e-4)
+            criterions = (GeneratorLoss(), L1ReconLoss(), TVLoss(), DiscriminatorHingeLoss(),
+                    VGGLoss('cpu', pretrained=False, shared=True), InfoNCE())
+            imgs = torch.rand((4, 3, 256, 256))*2 - 1
+            masks = torch.zeros((4, 1, 256, 256))
+            masks[:, :, 96:160, 64:192] = 1
+            train_step(netG, netD, optimG, optimD, criterions, TrainingPrecision('fp32', 'cpu'),
+                    imgs, masks, accumulation_steps)
+    finally:
+        dist.destroy_process_group()
+
+    # only the last micro batch all-reduces: D in its step and in the G step
+    # (its gradients there are not used), G in its step
+    assert calls[2] == calls[1]
+    assert calls[1]['g'] and calls[1]['d']
+
+def test_split_join_halves():
+    x = torch.arange(8)
+    micro_batches = split_halves(x, 2)
+    assert [m.tolist() for m in micro_batches] == [[0, 1, 4, 5], [2, 3, 6, 7]]
+    assert torch.equal(join_halves(micro_batches), x)
+
+def test_info_nce_queue():
+    torch.manual_seed(0)
+    loss = InfoNCE(queue_size=6)
+    query, positive_key = torch.randn((4, 8)), torch.randn((4, 8))
+    # empty queue: only the in-batch negatives
+    assert torch.allclose(loss(query, positive_key), info_nce(query, positive_key))
+    assert loss.queue.shape == (4, 8)
+
+    query2, positive_key2 = torch.randn((4, 8)), torch.randn((4, 8))
+    negative_keys = torch.cat([positive_key2, positive_key])
+    # in-batch keys followed by the keys queued by the first call
+    expected = torch.nn.functional.cross_entropy(
+            torch.nn.functional.normalize(query2, dim=-1) @
+            torch.nn.functional.normalize(negative_keys, dim=-1).T / 0.1, torch.arange(4))
+    assert torch.allclose(loss(query2, positive_key2), expected)
+    assert loss.queue.shape == (6, 8)
+    assert torch.allclose(loss.queue[:4], torch.nn.functional.normalize(positive_key2, dim=-1))
+
+def test_checkpointing_same_gradients():
+    torch.manual_seed(0)
+    nets = [MSSAGenerator(input_size=256, cnum=4)]
+    nets.append(MSSAGenerator(input_size=256, cnum=4, checkpointing=checkpoint_segments))
+    nets[1].load_state_dict(nets[0].state_dict())
+    imgs = torch.rand((2, 3, 256, 256))*2 - 1
+    masks = torch.randint(0, 2, (2, 1, 256, 256)).float()
+    for net in nets:
+        emb_repr, coarse_out, refined_out = net(imgs, masks)
+        (emb_repr.mean() + coarse_out.mean() + refined_out.mean()).backward()
+
+    for a, b in zip(nets[0].parameters(), nets[1].parameters()):
+        assert torch.allclose(a.grad, b.grad)
+    # the batch norms are not updated again by the recomputation
+    for a, b in zip(nets[0].buffers(), nets[1].buffers()):
+        assert torch.equal(a, b)
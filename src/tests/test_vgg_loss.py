@@ -0,0 +1,31 @@
+import os
+import sys
+import torch
+
+sys.path.append(f'{os.path.dirname(os.path.dirname(os.path.realpath(__file__)))}/gan_inpainting')
+from loss import VGGLoss
+
+def test_shared_vgg_loss():
+    torch.manual_seed(0)
+    legacy = VGGLoss('cpu', pretrained=False)
+    shared = VGGLoss('cpu', pretrained=False, shared=True, gram_cache_size=1)
+    shared.load_state_dict(legacy.state_dict())
+    real = torch.rand((4, 3, 64, 64))*2 - 1
+    generated = (torch.rand((4, 3, 64, 64))*2 - 1).requires_grad_()
+    # only the first image can be cached, the cache has room for one
+    keys = [0, 1, None, None]
+
+    expected = legacy(real, generated)
+    for _ in range(2):
+        loss_perc, loss_style = shared(real, generated, keys)
+        assert torch.allclose(loss_perc, expected[0])
+        assert torch.allclose(loss_style, expected[1])
+    assert list(shared.gram_cache) == [0]
+    # the cached grams are copies of their own row
+    assert [g.shape[0] for g in shared.gram_cache[0]] == [64, 128, 256, 512, 512]
+    assert all(g.untyped_storage().nbytes() == g.nelement()*g.element_size()
+            for g in shared.gram_cache[0])
+
+    # the gradient goes to the generated images
+    (loss_perc + loss_style).backward()
+    assert generated.grad is not None and generated.grad.abs().sum() > 0
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+import time
+import argparse
+import cv2
+from mask_detection import LandmarkDetector, prefetch_images
+from pipeline import Pipeline
+
+def read_frames(cap):
+    while True:
+        ok, frame = cap.read()
+        if not ok:
+            return
+        yield frame
+
+# run the stage fn over items in a background thread, keeping at most
+# prefetch results ready to be consumed
+def threaded(items, fn, prefetch):
+    for _, out in prefetch_images(items, fn, prefetch):
+        yield out
+
+# Read the frames of source (a video file or a webcam index), find the mask
+# and inpaint each of them, writing the result in output. Reading, mask
+# detection and inference run in 3 different threads connected by bounded
+# queues. FaceMesh runs in tracking mode, so landmarks of one frame are used to
+# find the face in the next one instead of running the face detector again.
+def process_video(source, output, checkpoint_dir, size=256, prefetch=8,
+        quantization='histogram', report_every=50):
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise IOError(f'unable to open {source}')
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25
+
+    writer = None
+    frames = 0
+    with LandmarkDetector(static_image_mode=False) as detector:
+        print("Loading network...")
+        pipeline = Pipeline(checkpoint_dir, size, detector, quantization)
+
+        start = time.perf_counter()
+        decoded = threaded(read_frames(cap), lambda frame: frame, prefetch)
+        masked = threaded(decoded, pipeline.prepare, prefetch)
+        for face, mask in masked:
+            out_frame = pipeline.inpaint(face, mask)
+            if writer is None:
+                fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+                writer = cv2.VideoWriter(output, fourcc, fps,
+                        (out_frame.shape[1], out_frame.shape[0]))
+            writer.write(out_frame)
+
+            frames += 1
+            if frames % report_every == 0:
+                print(f'[{frames}] {frames/(time.perf_counter() - start):.2f} fps')
+    cap.release()
+    if writer is not None:
+        writer.release()
+
+    elapsed = time.perf_counter() - start
+    print(f'{frames} frames in {elapsed:.2f}s, {frames/elapsed:.2f} fps')
+    return frames, elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Remove surgical masks from a video")
+    parser.add_argument("--input", type=str, help="The input video or webcam index", required=True)
+    parser.add_argument("--output", type=str, help="The output video", required=True)
+    parser.add_argument("--checkpoint_dir", type=str, help="where to load checkpoints", required=True)
+    parser.add_argument("--size", default=256, type=int, help="size of the shorter side of the output")
+    parser.add_argument("--prefetch", default=8, type=int, help="frames buffered between the stages")
+    parser.add_argument("--quantization", default='histogram', choices=['kmeans', 'histogram'],
+            help="color quantization used by find_mask")
+    args = parser.parse_args()
+
+    source = int(args.input) if args.input.isdigit() else args.input
+
+    process_video(source, args.output, args.checkpoint_dir, args.size,
+            args.prefetch, args.quantization)
@@ -3,8 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import thinplate as tps
 import random
-import mediapipe as mp
 from skimage import draw
+from mask_detection import get_detector
 
 bottom_face_landmarks = [0, 1, 2, 3, 4, 5, 11, 12, 13, 14, 15, 16, 17, 18, 19,
         20, 32, 36, 37, 38, 39, 40, 41, 42, 43, 44, 47, 48, 49, 50, 51, 57, 58,
@@ -65,7 +65,7 @@ def crop_image(img, mask):
     lnd = []
 
     for c in range(0, len(hullIndex)):
-        lnd.append(mask[int(hullIndex[c])])
+        lnd.append(mask[int(hullIndex[c][0])])
 
     cropped_img = np.zeros(img.shape, dtype=np.uint8)
     cv2.fillConvexPoly(cropped_img, np.int32(lnd), (1.0, 1.0, 1.0), 16, 0)
@@ -100,7 +100,7 @@ def trasformation_image(dst, cropped_img, lnd_src, lnd_dst):
     lnd = []
 
     for c in range(0, len(hullIndex)):
-        lnd.append(lnd_dst[int(hullIndex[c])])
+        lnd.append(lnd_dst[int(hullIndex[c][0])])
 
     base = np.copy(dst).astype(np.uint8)
     cv2.fillConvexPoly(base, np.int32(lnd), (0, 0, 0), 16, 0)
@@ -117,23 +117,18 @@ def trasformation_image(dst, cropped_img, lnd_src, lnd_dst):
 
 # would maybe be better if we take from lateral as much as we can to cover the
 # mask
-def warp_face(front, lateral, debug=False):
+def warp_face(front, lateral, debug=False, detector=None):
     # make the shape the same, this maybe can be removed in the future
     lateral = cv2.resize(lateral, (front.shape[1], front.shape[0]))
 
-    # init mediapipe net for facemesh
-    mpDraw = mp.solutions.drawing_utils
-    mpFaceMesh = mp.solutions.face_mesh
-    frontalFaceMesh = mpFaceMesh.FaceMesh(max_num_faces=1)
-    drawSpec = mpDraw.DrawingSpec(thickness=1, circle_radius=1)
-    lateralFaceMesh = mpFaceMesh.FaceMesh(max_num_faces=1)
+    # facemesh graphs are shared with the mask detection, see
+    # mask_detection.get_detector
+    if detector is None:
+        detector = get_detector()
 
     # process
-    front_kp = frontalFaceMesh.process(front)
-    lateral_kp = lateralFaceMesh.process(lateral)
-
-    front_lms = front_kp.multi_face_landmarks[0]
-    lateral_lms = lateral_kp.multi_face_landmarks[0]
+    front_lms = detector.process(front)
+    lateral_lms = detector.process(lateral)
 
     # # draw landmarks on image for debug purpose
     # front_marked = np.copy(front)